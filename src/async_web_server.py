@@ -0,0 +1,298 @@
+import asyncio
+import datetime
+import json
+import os
+import re
+from typing import Callable, List, Tuple
+from urllib.parse import urlsplit, parse_qsl, unquote
+from camera import Camera
+from encoder_pool import Encoder_Pool
+from flake_hunter import Flake_Hunter
+from image_writer import Image_Writer
+from wafer_mosaic import Wafer_Mosaic
+from scan_browser import Scan_Browser
+from video_broadcast import Video_Broadcaster
+
+# Registered blocking routes: (compiled path pattern, handler)
+_routes: List[Tuple[re.Pattern, Callable]] = []
+def http_route(pattern: str):
+    """Decorator to register a blocking route handler.
+    The handler gets (path match, query dict, request headers) and returns (status, content type, body)
+    or (status, content type, body, extra headers); it runs in the event loop's default executor."""
+    def decorator(func):
+        _routes.append((re.compile(pattern + "$"), func))
+        return func
+    return decorator
+
+
+class Async_Web_Server:
+    """
+    Serves the camera HTTP routes from the websocket server's event loop instead of Flask.
+    MJPEG viewers are coroutines fed by the same Video_Broadcaster as websocket viewers, so
+    an open stream costs no thread; everything blocking runs in the loop's executor.
+    Enabled with "server_mode": "asyncio" in config.json.
+    """
+    HOST = "127.0.0.1"
+    PORT = 5000
+    STATUS_TEXT = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found",
+                   405: "Method Not Allowed", 500: "Internal Server Error"}
+
+    # Same shape as web_server.active_streams
+    active_streams = dict()
+
+    @staticmethod
+    async def serve():
+        """Start listening; the server then runs for as long as the event loop does"""
+        for camera in Camera.cameras():
+            camera.snap_image()
+        server = await asyncio.start_server(Async_Web_Server.handle_client, Async_Web_Server.HOST, Async_Web_Server.PORT)
+        print(f"Serving camera routes on http://{Async_Web_Server.HOST}:{Async_Web_Server.PORT} (asyncio)")
+        return server
+
+    @staticmethod
+    async def handle_client(reader, writer):
+        try:
+            try:
+                request = await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                return
+            lines = request.decode("latin-1").split("\r\n")
+            try:
+                method, target, version = lines[0].split(" ", 2)
+            except ValueError:
+                await Async_Web_Server.respond(writer, 400, "text/plain", b"Bad request")
+                return
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+            if method not in ("GET", "HEAD"):
+                await Async_Web_Server.respond(writer, 405, "text/plain", b"Method not allowed")
+                return
+
+            url = urlsplit(target)
+            path = unquote(url.path)
+            query = dict(parse_qsl(url.query))
+
+            match = re.match(r"/video_feed(\d+)$", path)
+            if match:
+                await Async_Web_Server.stream_video(writer, int(match.group(1)), query)
+                return
+            match = re.match(r"/flake_hunt_feed(\d+)$", path)
+            if match:
+                await Async_Web_Server.stream_flake_hunt(writer, int(match.group(1)))
+                return
+
+            for pattern, handler in _routes:
+                match = pattern.match(path)
+                if match:
+                    loop = asyncio.get_running_loop()
+                    try:
+                        result = await loop.run_in_executor(None, handler, match, query, headers)
+                    except Exception as e:
+                        print(f"Error serving {path}: {e}")
+                        result = (500, "text/plain", f"Error: {e}".encode())
+                    status, content_type, body = result[:3]
+                    extra_headers = result[3] if len(result) > 3 else {}
+                    await Async_Web_Server.respond(writer, status, content_type,
+                                                   b"" if method == "HEAD" else body, extra_headers)
+                    return
+            await Async_Web_Server.respond(writer, 404, "text/plain", b"Not found")
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            print(f"HTTP handler error: {e}")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status, content_type, body, extra_headers=None):
+        head = [f"HTTP/1.1 {status} {Async_Web_Server.STATUS_TEXT.get(status, '')}",
+                f"Content-Type: {content_type}",
+                f"Content-Length: {len(body)}",
+                "Connection: close"]
+        head += [f"{name}: {value}" for name, value in (extra_headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    @staticmethod
+    async def stream_video(writer, camera_id, query):
+        """MJPEG stream fed from the shared broadcaster; a slow viewer skips frames"""
+        if camera_id not in Camera.global_list:
+            await Async_Web_Server.respond(writer, 404, "text/plain", b"Camera not found")
+            return
+        profile = Camera.resolve_stream_profile(query)
+        stream_id = f"video_{camera_id}_{id(writer)}"
+        Async_Web_Server.active_streams[stream_id] = {
+            'camera_id': camera_id,
+            'client': writer.get_extra_info("peername", ("unknown",))[0],
+            'profile': profile,
+            'start_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'active': True
+        }
+        slot = Video_Broadcaster.subscribe(camera_id, profile)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            while True:
+                frame_id, jpeg = await slot.get()
+                if jpeg is None:
+                    break
+                writer.write(Camera.as_multipart(jpeg))
+                await writer.drain()
+        finally:
+            Video_Broadcaster.unsubscribe(slot)
+            Async_Web_Server.active_streams.pop(stream_id, None)
+
+    @staticmethod
+    async def stream_flake_hunt(writer, camera_id):
+        """MJPEG stream of Flake_Hunter overlays; the blocking waits run in the executor"""
+        camera = Camera.global_list.get(camera_id)
+        if camera is None:
+            await Async_Web_Server.respond(writer, 404, "text/plain", b"Camera not found")
+            return
+        loop = asyncio.get_running_loop()
+        hunter = Flake_Hunter.get(camera)
+        hunter.acquire()
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                         b"Cache-Control: no-cache\r\n"
+                         b"Connection: close\r\n\r\n")
+            last_frame_id = 0  # Frame ids start at 1, so this waits for the first frame
+            while camera.is_active:
+                frame_id, jpeg = await loop.run_in_executor(None, hunter.get_overlay_frame, last_frame_id)
+                if jpeg is None:
+                    continue
+                last_frame_id = frame_id
+                writer.write(Camera.as_multipart(jpeg))
+                await writer.drain()
+                await asyncio.sleep(1.0 / Flake_Hunter.FPS)
+        finally:
+            hunter.release()
+
+
+def _json(data):
+    return 200, "application/json", json.dumps(data).encode()
+
+def _camera_or_404(match):
+    return Camera.global_list.get(int(match.group(1)))
+
+@http_route(r"/snapshot_feed(\d+)")
+def snapshot_feed(match, query, headers):
+    camera = _camera_or_404(match)
+    if not camera:
+        return 404, "text/plain", b"Camera not found"
+    frame = camera.get_snapshot_as_response()
+    if not frame:
+        return 500, "text/plain", b"Could not get snapshot"
+    return 200, "multipart/x-mixed-replace; boundary=frame", frame
+
+@http_route(r"/snapshot_flake_hunted(\d+)")
+def snapshot_flake_hunted_feed(match, query, headers):
+    camera = _camera_or_404(match)
+    if not camera:
+        return 404, "text/plain", b"Camera not found"
+    frame = camera.get_flake_hunted_snapshot_as_response()
+    if not frame:
+        return 500, "text/plain", b"Could not get flake hunted snapshot"
+    return 200, "multipart/x-mixed-replace; boundary=frame", frame
+
+@http_route(r"/snapshot_metrics(\d+)")
+def snapshot_metrics(match, query, headers):
+    camera = _camera_or_404(match)
+    if not camera:
+        return 404, "text/plain", b"Camera not found"
+    return _json(camera.get_snapshot_metrics())
+
+@http_route(r"/flake_hunt_stats(\d+)")
+def flake_hunt_stats(match, query, headers):
+    camera = _camera_or_404(match)
+    if not camera:
+        return 404, "text/plain", b"Camera not found"
+    return _json(Flake_Hunter.get(camera).stats())
+
+@http_route(r"/mosaic/([^/]+)/(\d+)/manifest\.json")
+def mosaic_manifest(match, query, headers):
+    scan_directory = Wafer_Mosaic.scan_path(match.group(1))
+    manifest = Wafer_Mosaic.load_manifest(scan_directory, int(match.group(2))) if scan_directory else None
+    if manifest is None:
+        return 404, "text/plain", b"Mosaic not found"
+    return 200, "application/json", json.dumps(manifest).encode(), {"Cache-Control": "no-cache"}
+
+@http_route(r"/mosaic/([^/]+)/(\d+)/(image|flakes)/(\d+)/(-?\d+)_(-?\d+)\.(?:jpg|png)")
+def mosaic_tile(match, query, headers):
+    directory, wafer, layer, level, col, row = match.groups()
+    path = Wafer_Mosaic.tile_file(directory, int(wafer), layer, int(level), int(col), int(row))
+    if path is None:
+        return 404, "text/plain", b"Tile not found"
+    # Tiles change while a wafer is scanned, so clients revalidate with the ETag
+    stat = os.stat(path)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    cache_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if headers.get("if-none-match") == etag:
+        return 304, "text/plain", b"", cache_headers
+    with open(path, "rb") as f:
+        body = f.read()
+    # "image" tiles are served from their PNG working copy until the wafer is finished
+    return 200, "image/jpeg" if path.endswith(".jpg") else "image/png", body, cache_headers
+
+@http_route(r"/scans")
+def scans(match, query, headers):
+    return _json(Scan_Browser.scans())
+
+@http_route(r"/scans/([^/]+)")
+def scan_wafers(match, query, headers):
+    wafers = Scan_Browser.wafers(match.group(1))
+    if wafers is None:
+        return 404, "text/plain", b"Scan not found"
+    return _json(wafers)
+
+@http_route(r"/scans/([^/]+)/(\d+)")
+def scan_images(match, query, headers):
+    try:
+        offset = int(query.get("offset", 0))
+        limit = int(query["limit"]) if "limit" in query else None
+    except ValueError:
+        return 400, "text/plain", b"offset and limit must be integers"
+    images = Scan_Browser.images(match.group(1), int(match.group(2)), offset, limit)
+    if images is None:
+        return 404, "text/plain", b"Wafer not found"
+    return _json(images)
+
+@http_route(r"/thumbnail/([^/]+)/(\d+)/(image|searched)/(\d+)/([^/]+)")
+def thumbnail(match, query, headers):
+    directory, wafer, kind, size, name = match.groups()
+    result = Scan_Browser.thumbnail(directory, int(wafer), name, kind, int(size))
+    if result is None:
+        return 404, "text/plain", b"Thumbnail not found"
+    path, version = result
+    # A request for the current version of the source can be cached for good; anything else revalidates
+    etag = f'"{size}-{version:x}"'
+    cache_control = "public, max-age=31536000, immutable" if query.get("v") == str(version) else "no-cache"
+    cache_headers = {"ETag": etag, "Cache-Control": cache_control}
+    if headers.get("if-none-match") == etag:
+        return 304, "text/plain", b"", cache_headers
+    with open(path, "rb") as f:
+        body = f.read()
+    return 200, "image/jpeg", body, cache_headers
+
+@http_route(r"/available_cameras")
+def available_cameras(match, query, headers):
+    return _json([camera.camera_id for camera in Camera.cameras()])
+
+@http_route(r"/active_streams")
+def active_streams(match, query, headers):
+    streams = dict(Async_Web_Server.active_streams)
+    return _json({'active_stream_count': len(streams), 'streams': streams})
+
+@http_route(r"/encoder_stats")
+def encoder_stats(match, query, headers):
+    return _json(Encoder_Pool.shared().stats())
+
+@http_route(r"/writer_stats")
+def writer_stats(match, query, headers):
+    return _json(Image_Writer.shared().stats())
@@ -0,0 +1,213 @@
+"""
+Benchmarks for the CV hot paths on synthetic wafer tiles.
+
+Run from src/ like the server:
+    python benchmark.py                    # run and print results
+    python benchmark.py --save-baseline    # also write ../benchmarks/baseline.json
+    python benchmark.py --compare          # compare against the saved baseline
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime
+import cv2
+import numpy as np
+from cv_functions import CV_Functions
+
+
+class Synthetic_Wafer:
+    """
+    Deterministic synthetic microscope tiles: a slightly uneven substrate with sensor noise and
+    flakes drawn at the contrasts of a contrast dictionary, so the detector has real work to do.
+    The same seed always gives the same tiles.
+    """
+    WIDTH = 2048
+    HEIGHT = 1536
+    # BGR substrate color of a typical SiO2 wafer under the microscope
+    SUBSTRATE = (150.0, 120.0, 170.0)
+    NOISE_STD = 2.0
+
+    def __init__(self, seed: int = 0, material: str = CV_Functions.DEFAULT_MATERIAL):
+        self.seed = seed
+        self.contrast_dict = CV_Functions.get_contrast_dict(material)
+        self.layers = sorted(self.contrast_dict.keys())
+
+    def tile(self, index: int, flakes: int = 3):
+        """Tile number index of this wafer with up to `flakes` flakes.
+        Returns (BGR uint8 image, ground truth list of {layer, center, area})."""
+        rng = np.random.default_rng((self.seed, index))
+        ys, xs = np.mgrid[0:Synthetic_Wafer.HEIGHT, 0:Synthetic_Wafer.WIDTH].astype(np.float32)
+        # Gentle illumination falloff towards the corners
+        radius = ((xs - Synthetic_Wafer.WIDTH / 2) ** 2 + (ys - Synthetic_Wafer.HEIGHT / 2) ** 2) / (Synthetic_Wafer.WIDTH / 2) ** 2
+        illumination = 1.0 - 0.05 * radius
+        image = np.empty((Synthetic_Wafer.HEIGHT, Synthetic_Wafer.WIDTH, 3), dtype=np.float32)
+        for channel, value in enumerate(Synthetic_Wafer.SUBSTRATE):
+            image[:, :, channel] = value * illumination
+
+        truth = []
+        for _ in range(rng.integers(0, flakes + 1)):
+            layer = self.layers[rng.integers(0, len(self.layers))]
+            contrast = self.contrast_dict[layer]["contrast"]
+            center = rng.uniform([200, 200], [Synthetic_Wafer.WIDTH - 200, Synthetic_Wafer.HEIGHT - 200])
+            points = center + rng.normal(0, rng.uniform(15, 80), size=(8, 2))
+            hull = cv2.convexHull(points.astype(np.int32))
+            mask = np.zeros(image.shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [hull], 1)
+            inside = mask > 0
+            for channel, name in enumerate("bgr"):
+                image[:, :, channel][inside] *= 1 + contrast[name]
+            truth.append({"layer": layer, "center": center.tolist(), "area": int(np.count_nonzero(inside))})
+
+        image += rng.normal(0, Synthetic_Wafer.NOISE_STD, size=image.shape).astype(np.float32)
+        return np.clip(image, 0, 255).astype(np.uint8), truth
+
+
+class Benchmark:
+    """Times each hot path on the same synthetic tiles and compares runs against a baseline file"""
+    BASELINE_PATH = "../benchmarks/baseline.json"
+    # A case is reported as a regression when its p50 is this much slower than the baseline's
+    TOLERANCE = 0.10
+
+    def __init__(self, tiles: int = 8, repeat: int = 5, seed: int = 0):
+        self.wafer = Synthetic_Wafer(seed)
+        self.tile_count = tiles
+        self.repeat = repeat
+        self.tiles = [self.wafer.tile(i)[0] for i in range(tiles)]
+        self.results = dict()
+
+    @staticmethod
+    def summarize(samples, items_per_sample: int = 1):
+        ordered = sorted(samples)
+        total = sum(ordered)
+        return {
+            "runs": len(ordered),
+            "mean_ms": round(1000 * total / len(ordered), 3),
+            "p50_ms": round(1000 * ordered[len(ordered) // 2], 3),
+            "p99_ms": round(1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3),
+            "per_second": round(items_per_sample * len(ordered) / total, 2) if total > 0 else None,
+        }
+
+    def time_case(self, name: str, func, inputs, items_per_sample: int = 1):
+        """Call func on every input `repeat` times (after one warm-up call) and record the timings"""
+        func(inputs[0])
+        samples = []
+        for _ in range(self.repeat):
+            for value in inputs:
+                start = time.perf_counter()
+                func(value)
+                samples.append(time.perf_counter() - start)
+        self.results[name] = Benchmark.summarize(samples, items_per_sample)
+        print(f"{name:<24} {self.results[name]}")
+
+    def run_cv(self):
+        self.time_case("run_searching", CV_Functions.run_searching, self.tiles)
+        searched = [(tile, CV_Functions.run_searching(tile)) for tile in self.tiles]
+        self.time_case("visualise_flakes", lambda pair: CV_Functions.visualise_flakes(pair[1], pair[0]), searched)
+        self.time_case("calculate_focus_score", CV_Functions.calculate_focus_score, self.tiles)
+        self.time_case("get_edge_count", CV_Functions.get_edge_count, self.tiles)
+        self.time_case("get_color_features", CV_Functions.get_color_features, self.tiles)
+        self.time_case("prescreen", CV_Functions.prescreen, self.tiles)
+
+    def run_encode(self):
+        self.time_case("jpeg_encode_q95", lambda tile: cv2.imencode(".jpg", tile, [cv2.IMWRITE_JPEG_QUALITY, 95]), self.tiles)
+        self.time_case("jpeg_encode_q80", lambda tile: cv2.imencode(".jpg", tile, [cv2.IMWRITE_JPEG_QUALITY, 80]), self.tiles)
+        self.time_case("png_encode", lambda tile: cv2.imencode(".png", tile), self.tiles)
+
+    def run_container_search(self):
+        """Search an N-tile scan directory end to end through Image_Container and the search pool"""
+        from image_container import Image_Container  # Pulls in the server modules, only needed here
+        directory = tempfile.mkdtemp(prefix="benchmark_scan_")
+        try:
+            wafer_directory = os.path.join(directory, "images", "wafer_1")
+            os.makedirs(wafer_directory)
+            wafer = []
+            for index, tile in enumerate(self.tiles):
+                name = f"0-tile-{index}.png"
+                cv2.imwrite(os.path.join(wafer_directory, name), tile)
+                wafer.append({"wafer_id": 1, "name": name, "camera_id": 0, "image_id": index + 1,
+                              "x": index, "y": 0, "flakes": []})
+            with open(os.path.join(directory, "metadata.json"), "w") as f:
+                json.dump({"wafers": [wafer], "searched": [], "metametadata": []}, f)
+
+            # An absolute directory is used as is by Image_Container
+            container = Image_Container(None, directory)
+            container.search_images(force=True)  # Warm-up, also starts the worker pool
+            samples = []
+            for _ in range(self.repeat):
+                start = time.perf_counter()
+                container.search_images(force=True)
+                samples.append(time.perf_counter() - start)
+            self.results["image_container_search"] = Benchmark.summarize(samples, self.tile_count)
+            print(f"{'image_container_search':<24} {self.results['image_container_search']} (per_second is tiles)")
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def report(self):
+        return {
+            "created": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "opencv": cv2.__version__,
+            "image_size": [Synthetic_Wafer.WIDTH, Synthetic_Wafer.HEIGHT],
+            "tiles": self.tile_count,
+            "repeat": self.repeat,
+            "seed": self.wafer.seed,
+            "results": self.results,
+        }
+
+    def save(self, path: str = BASELINE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print(f"Saved baseline to {path}")
+
+    def compare(self, path: str = BASELINE_PATH, tolerance: float = TOLERANCE):
+        """Print p50 changes against a saved baseline. Returns the names of cases that regressed"""
+        with open(path, "r") as f:
+            baseline = json.load(f)
+        print(f"Compared with baseline from {baseline.get('created')} ({baseline.get('platform')})")
+        regressions = []
+        for name, result in self.results.items():
+            before = baseline.get("results", {}).get(name)
+            if before is None:
+                print(f"{name:<24} new")
+                continue
+            change = result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0.0
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                regressions.append(name)
+            print(f"{name:<24} p50 {before['p50_ms']:>9.2f} -> {result['p50_ms']:>9.2f} ms ({100 * change:+.1f}%){flag}")
+        return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CV hot paths on synthetic wafer tiles")
+    parser.add_argument("--tiles", type=int, default=8, help="number of synthetic tiles")
+    parser.add_argument("--repeat", type=int, default=5, help="timed passes over the tiles per case")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-search", action="store_true", help="skip the Image_Container search case")
+    parser.add_argument("--baseline", default=Benchmark.BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=Benchmark.TOLERANCE)
+    args = parser.parse_args()
+
+    benchmark = Benchmark(args.tiles, args.repeat, args.seed)
+    benchmark.run_cv()
+    benchmark.run_encode()
+    if not args.skip_search:
+        benchmark.run_container_search()
+
+    regressed = []
+    if args.compare:
+        regressed = benchmark.compare(args.baseline, args.tolerance)
+    if args.save_baseline:
+        benchmark.save(args.baseline)
+    if regressed:
+        print(f"Slower than baseline: {', '.join(regressed)}")
+        raise SystemExit(1)
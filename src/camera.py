@@ -6,9 +6,14 @@ from cv_functions import CV_Functions
 import threading
 import time
 import weakref
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from socket_manager import Socket_Manager
 import transfer_functions
 import platform
+from frame_ring import Frame_Ring
+from encoder_pool import Encoder_Pool
 
 # if platform.system() == 'Windows':
     # from tisgrabber.wrapper import ImageControl
@@ -23,54 +28,56 @@ class Camera:
     # Keep track of all camera instances for cleanup
     _instances = weakref.WeakSet()
 
+    # Number of preallocated frame buffers each camera captures into
+    FRAME_RING_SIZE = Frame_Ring.DEFAULT_SIZE
+
+    # Stream profiles for the video routes. width None keeps full resolution, fps None is unthrottled
+    DEFAULT_JPEG_QUALITY = 95  # OpenCV's own default
+    STREAM_PROFILES = {
+        "full": {"width": None, "quality": DEFAULT_JPEG_QUALITY, "fps": None},
+        "preview": {"width": 1024, "quality": 80, "fps": 15},
+        "thumbnail": {"width": 512, "quality": 70, "fps": 5},
+    }
+    # Scaled widths are rounded to this step so clients share encodes; older encodings are evicted
+    STREAM_WIDTH_STEP = 64
+    MAX_ENCODED_PROFILES = 8
+
+    # Probing: device indices to try, how long one device may take, and where known devices are recorded
+    MAX_CAMERAS_TO_CHECK = 4
+    PROBE_TIMEOUT = 5.0  # seconds
+    INVENTORY_PATH = "../camera_settings/camera_inventory.json"
+    # Device indices with a probe still running (possibly past PROBE_TIMEOUT), so no other probe opens them
+    _probing = set()
+    _probe_lock = threading.Lock()
+
     @staticmethod
     # Figures out how many cameras are connected to the system
-    def initialize_all_cameras(sim_test=False):
-        max_cameras_to_check = 4
-        available_cameras = []
-        
+    def initialize_all_cameras(sim_test=False, use_inventory=True):
+        """Open every camera, probing device indices concurrently.
+
+        If a camera inventory from a previous run exists, the devices in it are reopened
+        straight away and the full probe runs in the background to pick up anything new.
+        """
         # First, clean up any existing cameras
         Camera.cleanup_all()
         
         # Clear the global list
         Camera.global_list.clear()
-        
-        print("Searching for cameras...")
-        for i in range(0, max_cameras_to_check):
-            try:
-                print(f"Trying camera {i}...")
-                if os.name == 'nt':  # Check if running on Windows
-                    cap = cv2.VideoCapture(i, cv2.CAP_DSHOW)
-                else:
-                    cap = cv2.VideoCapture(i)
-
-                # Set the resolution to the transfer station's resolution
-                cap.set(cv2.CAP_PROP_FRAME_WIDTH, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_width)
-                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_height)
-                ret, test_frame = cap.read()
-                cap.set(cv2.CAP_PROP_FRAME_WIDTH, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_width)
-                cap.set(cv2.CAP_PROP_FRAME_HEIGHT, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_height)
-             
-
-                if not ret or test_frame is None:
-                    print(f"  Camera {i} opened but could not read frame, skipping")
-                    cap.release()
-                    continue
-                    
-                print(f"  Camera {i} successfully initialized")
-                available_cameras.append(i)
-                
-                # Create camera instance
-                try:
-                    camera = Camera(i, cap)
-                    if camera.current_frame is None:
-                        print(f"  Warning: Camera {i} initialized but no frame captured")
-                except Exception as e:
-                    print(f"  Error initializing camera {i}: {e}")
-                    cap.release()
-                    continue
-            except Exception as e:
-                print(f"Error checking camera {i}: {e}")
+
+        inventory = Camera.load_inventory() if use_inventory else []
+        if inventory:
+            print(f"Reopening {len(inventory)} cameras from inventory...")
+            available_cameras = Camera._open_cameras(
+                [(entry["index"], entry.get("backend_id")) for entry in inventory]
+            )
+            probe_thread = threading.Thread(target=Camera._background_probe, daemon=True)
+            probe_thread.start()
+        else:
+            print("Searching for cameras...")
+            available_cameras = Camera._open_cameras(
+                [(i, None) for i in range(Camera.MAX_CAMERAS_TO_CHECK)]
+            )
+            Camera.save_inventory()
 
         if not available_cameras:
             print("No cameras detected on the system!")
@@ -78,6 +85,132 @@ class Camera:
         else: 
             print(f"Detected {len(available_cameras)} cameras: {available_cameras}")
             return available_cameras
+
+    @staticmethod
+    def _open_cameras(candidates):
+        """Probe (index, backend_id) candidates in parallel. Returns the indices that opened in time.
+        A probe that overruns PROBE_TIMEOUT is not waited for; if it succeeds later the camera still registers.
+        Indices that are already open or still being probed are skipped."""
+        with Camera._probe_lock:
+            candidates = [
+                (index, backend_id) for index, backend_id in candidates
+                if index not in Camera._probing and index not in Camera.global_list
+            ]
+            Camera._probing.update(index for index, backend_id in candidates)
+        if not candidates:
+            return []
+        executor = ThreadPoolExecutor(max_workers=len(candidates), thread_name_prefix="camera_probe")
+        futures = {executor.submit(Camera._probe_pending, index, backend_id): index for index, backend_id in candidates}
+        done, not_done = wait(futures, timeout=Camera.PROBE_TIMEOUT)
+        executor.shutdown(wait=False)
+
+        for future in not_done:
+            print(f"  Camera {futures[future]} did not respond within {Camera.PROBE_TIMEOUT}s, continuing without it")
+            # The inventory was saved without it; record it if it opens after all
+            future.add_done_callback(Camera._save_inventory_if_opened)
+        return sorted(futures[future] for future in done if future.result() is not None)
+
+    @staticmethod
+    def _background_probe():
+        """Probe the device indices that are not open yet, then refresh the inventory"""
+        candidates = [(i, None) for i in range(Camera.MAX_CAMERAS_TO_CHECK) if i not in Camera.global_list]
+        found = Camera._open_cameras(candidates)
+        if found:
+            print(f"Background probe found cameras: {found}")
+        Camera.save_inventory()
+
+    @staticmethod
+    def _save_inventory_if_opened(future):
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            print(f"Camera {future.result().camera_id} opened late, adding it to the inventory")
+            Camera.save_inventory()
+
+    @staticmethod
+    def cameras():
+        """Snapshot of the open cameras; probes can add cameras while callers iterate"""
+        with Camera._lock:
+            return list(Camera.global_list.values())
+
+    @staticmethod
+    def _probe_pending(index, backend_id=None):
+        """_probe_camera for an index claimed in _probing; releases the claim once the probe is over"""
+        try:
+            return Camera._probe_camera(index, backend_id)
+        finally:
+            with Camera._probe_lock:
+                Camera._probing.discard(index)
+
+    @staticmethod
+    def _probe_camera(index, backend_id=None):
+        """Open one device and start a Camera on it. Returns the Camera, or None if it is not usable"""
+        try:
+            print(f"Trying camera {index}...")
+            if backend_id is not None:
+                cap = cv2.VideoCapture(index, backend_id)
+            elif os.name == 'nt':  # Check if running on Windows
+                cap = cv2.VideoCapture(index, cv2.CAP_DSHOW)
+            else:
+                cap = cv2.VideoCapture(index)
+
+            # Set the resolution to the transfer station's resolution
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_height)
+            ret, test_frame = cap.read()
+            cap.set(cv2.CAP_PROP_FRAME_WIDTH, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_width)
+            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, transfer_functions.Transfer_Functions.TRANSFER_STATION.camera_height)
+
+            if not ret or test_frame is None:
+                print(f"  Camera {index} opened but could not read frame, skipping")
+                cap.release()
+                return None
+
+            print(f"  Camera {index} successfully initialized")
+
+            # Create camera instance
+            try:
+                camera = Camera(index, cap)
+                camera.device_info = {
+                    "index": index,
+                    "width": int(test_frame.shape[1]),
+                    "height": int(test_frame.shape[0]),
+                    "backend": cap.getBackendName(),
+                    "backend_id": int(cap.get(cv2.CAP_PROP_BACKEND)),
+                }
+                if camera.current_frame is None:
+                    print(f"  Warning: Camera {index} initialized but no frame captured")
+                return camera
+            except Exception as e:
+                print(f"  Error initializing camera {index}: {e}")
+                cap.release()
+                return None
+        except Exception as e:
+            print(f"Error checking camera {index}: {e}")
+            return None
+
+    @staticmethod
+    def load_inventory():
+        """Load the cameras recorded by the last probe, or [] if there is no usable inventory"""
+        try:
+            with open(Camera.INVENTORY_PATH, "r") as f:
+                return list(json.load(f).get("cameras", []))
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            print(f"Error reading camera inventory: {e}")
+            return []
+
+    @staticmethod
+    def save_inventory():
+        """Record the currently open cameras so the next start can reopen them without probing"""
+        cameras = [
+            camera.device_info for camera in Camera.cameras()
+            if getattr(camera, "device_info", None) is not None
+        ]
+        try:
+            with open(Camera.INVENTORY_PATH, "w") as f:
+                json.dump({"cameras": sorted(cameras, key=lambda entry: entry["index"])}, f, indent=2)
+        except Exception as e:
+            print(f"Error saving camera inventory: {e}")
     
     @staticmethod
     def cleanup_all():
@@ -93,12 +226,24 @@ class Camera:
         self.video = cap
         self.is_active = True
         self.camera_id = cameraId
+        self.device_info = None  # Inventory entry (index, resolution, backend) once probed
         self.frame_lock = threading.Lock()
         
-        # Initialize frame buffers
-        self.current_frame = None
+        # Initialize frame buffers; captured frames live in the ring, each with an id and timestamp
+        self.frame_ring = Frame_Ring(Camera.FRAME_RING_SIZE)
         self.snapshot_image = None
         self.snapshot_image_flake_hunted = None
+        # Bumped on every snap so cached metrics / encodings can tell they are stale
+        self.snapshot_id = 0
+        self.snapshot_flake_hunted_id = 0
+        # {"id", "metrics", "response"} for the current snapshot, built on its first fetch
+        self.snapshot_cache = None
+        self.snapshot_flake_hunted_cache = None
+        self.snapshot_cache_lock = threading.Lock()
+
+        # JPEG of the latest frame per (width, quality), shared by every viewer of this camera
+        self.encode_lock = threading.Lock()
+        self.encoded_frames = OrderedDict()
         
         # Start frame capture thread
         self.capture_thread = threading.Thread(target=self._capture_frames, daemon=True)
@@ -106,12 +251,8 @@ class Camera:
         
         # Wait for first frame
         timeout = 3.0  # seconds
-        start_time = time.time()
-        while self.current_frame is None:
-            time.sleep(0.1)
-            if time.time() - start_time > timeout:
-                print(f"Warning: Timeout waiting for first frame from camera {cameraId}")
-                break
+        if not self.frame_ring.wait_for_id(0, timeout):
+            print(f"Warning: Timeout waiting for first frame from camera {cameraId}")
         
         # Store in global list and instances set
         with Camera._lock:
@@ -122,11 +263,30 @@ class Camera:
         """Clean up resources when the camera is deleted"""
         self.cleanup()
 
+    @property
+    def frame_id(self):
+        """Id of the most recent frame; increases by one for every captured frame"""
+        return self.frame_ring.latest_id
+
+    @property
+    def frame_timestamp(self):
+        """time.time() at which the most recent frame was captured"""
+        return self.frame_ring.latest_timestamp
+
+    @property
+    def current_frame(self):
+        """The most recent frame buffer (not a copy, may be reused); prefer get_frame or lease_frame"""
+        lease = self.frame_ring.lease_latest()
+        if lease is None:
+            return None
+        with lease:
+            return lease.frame
+
     def cleanup(self):
         """Clean up resources explicitly"""
         if hasattr(self, 'is_active') and self.is_active:
             self.is_active = False
-            
+
             # Wait for capture thread to terminate
             if hasattr(self, 'capture_thread') and self.capture_thread.is_alive():
                 try:
@@ -142,10 +302,13 @@ class Camera:
                 except Exception as e:
                     print(f"Error releasing camera {self.camera_id}: {e}")
                     
-            # Clear frame buffers
-            self.current_frame = None
+            # Clear frame buffers and wake anyone blocked in wait_for_frame
+            self.frame_ring.close()
             self.snapshot_image = None
             self.snapshot_image_flake_hunted = None
+            self.snapshot_cache = None
+            self.snapshot_flake_hunted_cache = None
+            self.encoded_frames.clear()
 
     def _capture_frames(self):
         """Background thread to continuously capture frames"""
@@ -158,8 +321,12 @@ class Camera:
                     time.sleep(0.1)
                     continue
                 
-                # Capture frame
-                ret, frame = self.video.read()
+                # Capture frame straight into a free ring buffer
+                slot, buffer = self.frame_ring.begin_write()
+                if buffer is not None:
+                    ret, frame = self.video.read(buffer)
+                else:
+                    ret, frame = self.video.read()
 
                 if not ret:
                     # Limit error logging to avoid flooding
@@ -179,9 +346,8 @@ class Camera:
                 # Reset error count on successful frame
                 error_count = 0
                 
-                # Update current frame with thread safety
-                with self.frame_lock:
-                    self.current_frame = frame
+                # Publish the frame; if every buffer is leased the frame is dropped
+                self.frame_ring.commit(slot, frame)
                 
                 # Don't capture too fast
                 time.sleep(0.01)
@@ -192,29 +358,124 @@ class Camera:
 
     def get_frame(self):
         """Get the most recent frame (thread-safe)"""
-        with self.frame_lock:
-            if self.current_frame is None:
-                return None
-            return self.current_frame.copy()
+        lease = self.frame_ring.lease_latest()
+        if lease is None:
+            return None
+        with lease:
+            return lease.frame.copy()
+
+    def lease_frame(self, after_id=None, timeout=None):
+        """Lease the newest frame once one newer than after_id exists (after this call if None).
+
+        The lease gives read-only, copy-free access to the frame; release it promptly.
+        Returns None on timeout.
+        """
+        return self.frame_ring.lease_after(after_id, timeout)
+
+    def lease_frame_captured_after(self, timestamp, timeout=None):
+        """Lease the earliest buffered frame captured after timestamp (time.time()), or None on timeout"""
+        return self.frame_ring.lease_captured_after(timestamp, timeout)
+
+    def wait_for_frame(self, after_id=None, timeout=None):
+        """Wait for a frame captured after frame after_id (or after this call if None).
+
+        Returns (frame_id, timestamp, frame copy); frame is None if the wait timed out.
+        """
+        lease = self.lease_frame(after_id, timeout)
+        if lease is None:
+            return self.frame_id, self.frame_timestamp, None
+        with lease:
+            return lease.frame_id, lease.timestamp, lease.frame.copy()
+
+    @staticmethod
+    def resolve_stream_profile(args):
+        """Turn request arguments (profile, width, quality, fps) into a {width, quality, fps} profile.
+        Explicit values override the named profile; missing or invalid values fall back to it."""
+        profile = dict(Camera.STREAM_PROFILES.get(args.get("profile", "full"), Camera.STREAM_PROFILES["full"]))
+        try:
+            if args.get("width"):
+                step = Camera.STREAM_WIDTH_STEP
+                profile["width"] = max(step, int(round(int(args["width"]) / step)) * step)
+            if args.get("quality"):
+                profile["quality"] = min(100, max(10, int(args["quality"])))
+            if args.get("fps"):
+                fps = float(args["fps"])
+                profile["fps"] = fps if fps > 0 else None
+        except (TypeError, ValueError) as e:
+            print(f"Ignoring invalid stream parameters {dict(args)}: {e}")
+        return profile
+
+    def _encode_entry(self, key):
+        """Cache slot for one (width, quality) encoding, created on first use"""
+        with self.encode_lock:
+            entry = self.encoded_frames.get(key)
+            if entry is None:
+                entry = {"lock": threading.Lock(), "frame_id": 0, "jpeg": None, "multipart": None}
+                self.encoded_frames[key] = entry
+                while len(self.encoded_frames) > Camera.MAX_ENCODED_PROFILES:
+                    self.encoded_frames.popitem(last=False)
+            else:
+                self.encoded_frames.move_to_end(key)
+            return entry
+
+    def get_encoded_frame(self, width=None, quality=DEFAULT_JPEG_QUALITY, multipart=True):
+        """Get (frame_id, multipart JPEG chunk) for the most recent frame.
+
+        Each captured frame is scaled and encoded at most once per (width, quality);
+        every viewer asking for the same profile gets the same bytes.
+        With multipart=False the bare JPEG bytes are returned instead.
+        """
+        key = "multipart" if multipart else "jpeg"
+        lease = self.frame_ring.lease_latest()
+        if lease is None:
+            return self.frame_id, None
+
+        entry = self._encode_entry((width, quality))
+        # The lease keeps the capture thread out of this buffer while it is encoded
+        with lease, entry["lock"]:
+            frame_id = lease.frame_id
+            if entry["jpeg"] is not None and entry["frame_id"] == frame_id:
+                return frame_id, entry[key]
+            try:
+                frame = lease.frame
+                if width is not None and width < frame.shape[1]:
+                    height = int(round(frame.shape[0] * width / frame.shape[1]))
+                    frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                jpg = Camera.encode_jpeg(frame, quality, live=True)
+                if jpg is None:
+                    return frame_id, None
+                entry["jpeg"] = jpg
+                entry["multipart"] = Camera.as_multipart(jpg)
+                entry["frame_id"] = frame_id
+                return frame_id, entry[key]
+            except Exception as e:
+                print(f"Error encoding frame: {e}")
+                return frame_id, None
+
+    def wait_for_encoded_frame(self, after_id, timeout=None, width=None, quality=DEFAULT_JPEG_QUALITY, multipart=True):
+        """Like get_encoded_frame, but first wait for a frame newer than after_id"""
+        if not self.frame_ring.wait_for_id(after_id, timeout):
+            return after_id, None
+        return self.get_encoded_frame(width, quality, multipart)
 
     def get_single_frame_as_response(self):
         """Get a single frame formatted as an HTTP response"""
-        frame = self.get_frame()
-        if frame is None:
-            return None
-            
-        try:
-            ret, png = cv2.imencode(".jpg", frame)
-            if not ret:
-                return None
-                
-            return (
-                b"--frame\r\n"
-                b"Content-Type: image/jpeg\r\n\r\n" + png.tobytes() + b"\r\n\r\n"
-            )
-        except Exception as e:
-            print(f"Error encoding frame: {e}")
-            return None
+        frame_id, frame = self.get_encoded_frame()
+        return frame
+
+    @staticmethod
+    def encode_jpeg(image, quality=DEFAULT_JPEG_QUALITY, live=False):
+        """JPEG-encode image on the shared encoder pool. Returns bytes, or None if dropped or failed.
+        live marks stream frames, which may be dropped under load rather than queued."""
+        return Encoder_Pool.shared().encode(image, ".jpg", [cv2.IMWRITE_JPEG_QUALITY, quality], live=live)
+
+    @staticmethod
+    def as_multipart(jpg_bytes):
+        """Wrap encoded JPEG bytes as one part of a multipart/x-mixed-replace stream"""
+        return (
+            b"--frame\r\n"
+            b"Content-Type: image/jpeg\r\n\r\n" + jpg_bytes + b"\r\n\r\n"
+        )
 
     def save_image(self, frame):
         """Save an image to disk"""
@@ -231,12 +492,21 @@ class Camera:
             print(f"Error saving image: {e}")
 
 
-    def snap_image(self):
-        """Take a snapshot and store it"""
-        frame = self.get_frame()
-
+    def snap_image(self, captured_after=None):
+        """Take a snapshot and store it.
+        If captured_after (a time.time() value) is given, use the first frame captured after it."""
+        frame = None
+        if captured_after is not None:
+            lease = self.lease_frame_captured_after(captured_after, timeout=1.0)
+            if lease is not None:
+                with lease:
+                    frame = lease.frame.copy()
+        if frame is None:
+            frame = self.get_frame()
 
-        self.snapshot_image = frame
+        with self.frame_lock:
+            self.snapshot_image = frame
+            self.snapshot_id += 1
         Socket_Manager.send_all_json({"type": "REFRESH_SNAPSHOT", "camera": self.camera_id})
         return self.snapshot_image
 
@@ -251,56 +521,92 @@ class Camera:
             processed_frame = CV_Functions.matGMM2DTransform(frame)
             with self.frame_lock:
                 self.snapshot_image_flake_hunted = processed_frame
+                self.snapshot_flake_hunted_id += 1
             return self.snapshot_image_flake_hunted
         except Exception as e:
             print(f"Error in flake hunting: {e}")
             return None
 
-    def get_snapshot_as_response(self):
-        """Get the snapshot as an HTTP response"""
+    @staticmethod
+    def snapshot_metrics(frame):
+        """Focus score, edge count and color ratio of a snapshot"""
+        return {
+            "focus_score": float(CV_Functions.calculate_focus_score(frame)),
+            "edge_count": int(CV_Functions.get_edge_count(frame)),
+            "color_ratio": float(CV_Functions.get_color_features(frame)),
+        }
+
+    @staticmethod
+    def draw_snapshot_metrics(frame, metrics):
+        """Copy of frame with the snapshot metrics written in the top left corner"""
+        overlay = frame.copy()
+
+        # Add focus score text to the frame
+        cv2.putText(
+            overlay,
+            f"Focus Score: {metrics['focus_score']:.2f} {metrics['edge_count']}",
+            (10, 30),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            (255, 255, 255),  # White text
+            2  # Thickness
+        )
+
+        cv2.putText(
+            overlay,
+            f"Color Ratio: {metrics['color_ratio']:.2f}",
+            (10, 60),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            1,
+            (255, 255, 255),  # White text
+            2  # Thickness
+        )
+        return overlay
+
+    @staticmethod
+    def blank_response():
+        """Placeholder image for when there is no snapshot to show"""
+        png = Camera.encode_jpeg(np.zeros((480, 640, 3), np.uint8))
+        if png is None:
+            return None
+        return Camera.as_multipart(png)
+
+    def _snapshot_cache_entry(self):
+        """Metrics and encoded overlay for the current snapshot, computed once per snap"""
         # Take a new snapshot if needed
         if self.snapshot_image is None:
             self.snap_image()
-            
+
         # Get the snapshot with thread safety
         with self.frame_lock:
             frame = self.snapshot_image
-            
+            snapshot_id = self.snapshot_id
         if frame is None:
-            # Return a blank image if we can't get a real one
-            blank_image = np.zeros((480, 640, 3), np.uint8)
-            ret, png = cv2.imencode(".jpg", blank_image)
-        else:
-            focus_score = CV_Functions.calculate_focus_score(frame)
-            has_enough_edges = CV_Functions.get_edge_count(frame)
-            color_ratio = CV_Functions.get_color_features(frame)
+            return None
 
-            # Add focus score text to the frame
-            cv2.putText(
-                frame,
-                f"Focus Score: {focus_score:.2f} {has_enough_edges}",
-                (10, 30),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),  # White text
-                2  # Thickness
-            )
+        with self.snapshot_cache_lock:
+            cache = self.snapshot_cache
+            if cache is None or cache["id"] != snapshot_id:
+                metrics = Camera.snapshot_metrics(frame)
+                png = Camera.encode_jpeg(Camera.draw_snapshot_metrics(frame, metrics))
+                if png is None:
+                    return None
+                cache = {"id": snapshot_id, "metrics": metrics, "response": Camera.as_multipart(png)}
+                self.snapshot_cache = cache
+            return cache
 
-            cv2.putText(
-                frame,
-                f"Color Ratio: {color_ratio:.2f}",
-                (10, 60),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),  # White text
-                2  # Thickness
-            )
-            ret, png = cv2.imencode(".jpg", frame)
-            
-        return (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + png.tobytes() + b"\r\n\r\n"
-        )
+    def get_snapshot_metrics(self):
+        """Metrics of the current snapshot, or None if there is no snapshot"""
+        cache = self._snapshot_cache_entry()
+        return None if cache is None else cache["metrics"]
+
+    def get_snapshot_as_response(self):
+        """Get the snapshot (with its metrics drawn on) as an HTTP response"""
+        cache = self._snapshot_cache_entry()
+        if cache is None:
+            # Return a blank image if we can't get a real one
+            return Camera.blank_response()
+        return cache["response"]
 
     def get_flake_hunted_snapshot_as_response(self):
         """Get the flake hunted snapshot as an HTTP response"""
@@ -311,46 +617,55 @@ class Camera:
         # Get the snapshot with thread safety
         with self.frame_lock:
             frame = self.snapshot_image_flake_hunted
+            snapshot_id = self.snapshot_flake_hunted_id
             
         if frame is None:
             # Return a blank image if we can't get a real one
-            blank_image = np.zeros((480, 640, 3), np.uint8)
-            ret, png = cv2.imencode(".jpg", blank_image)
-        else:
-            ret, png = cv2.imencode(".jpg", frame)
-            
-        return (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + png.tobytes() + b"\r\n\r\n"
-        )
+            return Camera.blank_response()
+
+        with self.snapshot_cache_lock:
+            cache = self.snapshot_flake_hunted_cache
+            if cache is None or cache["id"] != snapshot_id:
+                png = Camera.encode_jpeg(frame)
+                if png is None:
+                    return None
+                cache = {"id": snapshot_id, "response": Camera.as_multipart(png)}
+                self.snapshot_flake_hunted_cache = cache
+            return cache["response"]
 
     @staticmethod
-    def generate_video(camera):
-        """Generate video frames with proper resource management"""
+    def generate_video(camera, profile=None):
+        """Generate video frames with proper resource management.
+        profile is a {width, quality, fps} dict as returned by resolve_stream_profile."""
+        profile = profile or Camera.STREAM_PROFILES["full"]
+        last_frame_id = 0  # Frame ids start at 1, so this waits for the first frame
+        last_sent = 0.0
         try:
             while camera.is_active:
-                frame = camera.get_frame()
+                Camera.throttle_stream(last_sent, profile["fps"])
+                frame_id, frame = camera.wait_for_encoded_frame(
+                    last_frame_id, timeout=1.0, width=profile["width"], quality=profile["quality"]
+                )
                 if frame is None:
-                    # If we can't get a frame, pause briefly and try again
-                    import time
-                    time.sleep(0.1)
-                    continue
-                    
-                # frame = Camera.matGMM2DTransform(frame)
-                ret, png = cv2.imencode(".jpg", frame)
-                if not ret:
                     continue
-                    
-                yield (
-                    b"--frame\r\n"
-                    b"Content-Type: image/jpeg\r\n\r\n" + png.tobytes() + b"\r\n\r\n"
-                )
+
+                last_frame_id = frame_id
+                last_sent = time.time()
+                yield frame
         except Exception as e:
             print(f"Error in generate_video for camera {camera.camera_id}: {e}")
         finally:
             # Ensure we don't leave any resources hanging
             pass
 
+    @staticmethod
+    def throttle_stream(last_sent, fps):
+        """Sleep until the next frame is due for a stream capped at fps (no cap if fps is None)"""
+        if fps:
+            remaining = last_sent + 1.0 / fps - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
+
     @staticmethod
     def get_snapped_image_flake_hunted(camera):
         if not hasattr(camera, 'snapshot_image') or camera.snapshot_image is None:
@@ -362,14 +677,13 @@ class Camera:
         if camera.snapshot_image_flake_hunted is None:
             # Return a blank image if we can't get a real one
             blank_image = np.zeros((480, 640, 3), np.uint8)
-            ret, png = cv2.imencode(".jpg", blank_image)
+            png = Camera.encode_jpeg(blank_image)
         else:
-            ret, png = cv2.imencode(".jpg", camera.snapshot_image_flake_hunted)
+            png = Camera.encode_jpeg(camera.snapshot_image_flake_hunted)
             
-        return (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + png.tobytes() + b"\r\n\r\n"
-        )
+        if png is None:
+            return None
+        return Camera.as_multipart(png)
 
     @staticmethod
     def get_snapped_image(camera):
@@ -379,11 +693,10 @@ class Camera:
         if camera.snapshot_image is None:
             # Return a blank image if we can't get a real one
             blank_image = np.zeros((480, 640, 3), np.uint8)
-            ret, png = cv2.imencode(".jpg", blank_image)
+            png = Camera.encode_jpeg(blank_image)
         else:
-            ret, png = cv2.imencode(".jpg", camera.snapshot_image)
+            png = Camera.encode_jpeg(camera.snapshot_image)
             
-        return (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + png.tobytes() + b"\r\n\r\n"
-        )
\ No newline at end of file
+        if png is None:
+            return None
+        return Camera.as_multipart(png)
\ No newline at end of file
@@ -3,26 +3,153 @@ from GMMDetector import MaterialDetector
 import numpy as np
 import matplotlib.cm as cm
 import json
+import hashlib
+import os
+import threading
+import time
 
 class CV_Functions:
 
+    CONTRAST_DICT_DIR = "../contrastDictDir"
+    DEFAULT_MATERIAL = "Graphene"
+    # Detector settings used for flake searching
+    SIZE_THRESHOLD = 500
+    STD_THRESHOLD = 5
+    USED_CHANNELS = "BGR"
+
+    # Pre-screen: a cheap test on a downscaled tile that rejects tiles which cannot hold a flake
+    # above size_threshold, so most bare-substrate tiles skip the detector. A pixel is a candidate
+    # if its contrast is within std_threshold standard deviations of some layer on every channel;
+    # that box contains the detector's own acceptance region, so only the area estimate can be wrong.
+    # The tile passes if candidate pixels (scaled back to full size) reach PRESCREEN_MARGIN * size_threshold.
+    PRESCREEN_ENABLED = False
+    PRESCREEN_DOWNSCALE = 4
+    PRESCREEN_MARGIN = 0.5
+
     contrast_dict = json.load(open("../contrastDictDir/Graphene_GMM.json", "r"))
 
+    # Detectors are built once per (material, size_threshold, std_threshold, channels) and shared
+    # by every thread; contrast dicts are cached per material. reload_detectors() drops both.
+    _detectors = dict()
+    _contrast_dicts = dict()
+    _detector_lock = threading.Lock()
+
     def __init__(self) -> None:
         self.mockImage = np.zeros((512, 512, 3), dtype=np.uint8)
         CV_Functions.matGMM2DTransform(self.mockImage)
 
-    def run_searching(img):
-        model = MaterialDetector(
-            contrast_dict=CV_Functions.contrast_dict,
-            size_threshold=500,
-            standard_deviation_threshold=5,
-            used_channels="BGR",
-        )
+    def contrast_dict_path(material):
+        return os.path.join(CV_Functions.CONTRAST_DICT_DIR, f"{material}_GMM.json")
+
+    def get_contrast_dict(material=DEFAULT_MATERIAL):
+        """Contrast dictionary of a material, read from disk once"""
+        with CV_Functions._detector_lock:
+            if material not in CV_Functions._contrast_dicts:
+                with open(CV_Functions.contrast_dict_path(material), "r") as f:
+                    CV_Functions._contrast_dicts[material] = json.load(f)
+            return CV_Functions._contrast_dicts[material]
+
+    def get_detector(material=DEFAULT_MATERIAL, size_threshold=SIZE_THRESHOLD,
+                     std_threshold=STD_THRESHOLD, channels=USED_CHANNELS):
+        """The shared MaterialDetector for these settings, built on first use"""
+        key = (material, size_threshold, std_threshold, channels)
+        detector = CV_Functions._detectors.get(key)
+        if detector is not None:
+            return detector
+        contrast_dict = CV_Functions.get_contrast_dict(material)
+        with CV_Functions._detector_lock:
+            if key not in CV_Functions._detectors:
+                CV_Functions._detectors[key] = MaterialDetector(
+                    contrast_dict=contrast_dict,
+                    size_threshold=size_threshold,
+                    standard_deviation_threshold=std_threshold,
+                    used_channels=channels,
+                )
+            return CV_Functions._detectors[key]
+
+    def reload_detectors(material=None):
+        """Forget cached contrast dicts and detectors (of one material, or all) so the next
+        search rebuilds them from the JSON on disk. Returns how many detectors were dropped."""
+        with CV_Functions._detector_lock:
+            stale = [key for key in CV_Functions._detectors if material is None or key[0] == material]
+            for key in stale:
+                del CV_Functions._detectors[key]
+            for name in list(CV_Functions._contrast_dicts):
+                if material is None or name == material:
+                    del CV_Functions._contrast_dicts[name]
+        if material in (None, CV_Functions.DEFAULT_MATERIAL):
+            CV_Functions.contrast_dict = CV_Functions.get_contrast_dict(CV_Functions.DEFAULT_MATERIAL)
+        return len(stale)
+
+    def preload_detectors():
+        """Build the default detector up front; used as the initializer of search worker processes"""
+        CV_Functions.get_detector()
+
+    def search_fingerprint(prescreen=None, material=DEFAULT_MATERIAL):
+        """Short hash of everything that decides what a search finds: the contrast dictionary,
+        detector thresholds and, when it can reject tiles, the pre-screen settings"""
+        if prescreen is None:
+            prescreen = CV_Functions.PRESCREEN_ENABLED
+        config = {
+            "material": material,
+            "contrast_dict": CV_Functions.get_contrast_dict(material),
+            "size_threshold": CV_Functions.SIZE_THRESHOLD,
+            "std_threshold": CV_Functions.STD_THRESHOLD,
+            "channels": CV_Functions.USED_CHANNELS,
+            "prescreen": [CV_Functions.PRESCREEN_DOWNSCALE, CV_Functions.PRESCREEN_MARGIN] if prescreen else None,
+        }
+        return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+    def run_searching(img, material=DEFAULT_MATERIAL, size_threshold=SIZE_THRESHOLD,
+                      std_threshold=STD_THRESHOLD, channels=USED_CHANNELS):
+        model = CV_Functions.get_detector(material, size_threshold, std_threshold, channels)
 
         flakes = model.detect_flakes(img)
         return flakes
 
+    def prescreen(img, material=DEFAULT_MATERIAL, size_threshold=SIZE_THRESHOLD, std_threshold=STD_THRESHOLD):
+        """True if the tile may contain a flake and should go to the detector"""
+        scale = CV_Functions.PRESCREEN_DOWNSCALE
+        small = cv2.resize(img, None, fx=1 / scale, fy=1 / scale, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+        # Bare substrate covers most of a tile, so the per-channel median is the background
+        background = np.median(small.reshape(-1, 3), axis=0)
+        contrast = (small - background) / np.maximum(background, 1)
+
+        candidates = np.zeros(small.shape[:2], dtype=bool)
+        for layer in CV_Functions.get_contrast_dict(material).values():
+            mean = np.array([layer["contrast"][channel] for channel in "bgr"], dtype=np.float32)
+            std = np.sqrt(np.diag(np.array(layer["covariance_matrix"], dtype=np.float32)))
+            candidates |= np.all(np.abs(contrast - mean) <= std_threshold * std, axis=2)
+
+        estimated_pixels = np.count_nonzero(candidates) * scale * scale
+        return estimated_pixels >= CV_Functions.PRESCREEN_MARGIN * size_threshold
+
+    def search_tile(img, prescreen=None, validate=False):
+        """Search one tile, optionally pre-screening it first.
+
+        Returns (flakes, info); info has "rejected", "prescreen_ms" and "detect_ms". With validate set
+        the detector still runs on every tile and its result is kept; for rejected tiles
+        info["false_reject"] says whether the detector found flakes the pre-screen would have missed.
+        """
+        if prescreen is None:
+            prescreen = CV_Functions.PRESCREEN_ENABLED
+        info = {"rejected": False, "prescreen_ms": None, "detect_ms": None, "false_reject": None}
+
+        if prescreen:
+            start = time.perf_counter()
+            info["rejected"] = not CV_Functions.prescreen(img)
+            info["prescreen_ms"] = 1000 * (time.perf_counter() - start)
+            if info["rejected"] and not validate:
+                return [], info
+
+        start = time.perf_counter()
+        flakes = CV_Functions.run_searching(img)
+        info["detect_ms"] = 1000 * (time.perf_counter() - start)
+        if info["rejected"]:
+            info["false_reject"] = len(flakes) > 0
+        return flakes, info
+
     def matGMM2DTransform(img):
         flakes = CV_Functions.run_searching(img)
 
@@ -131,6 +258,19 @@ class CV_Functions:
 
         return image
 
+    def settle_signature(image, width=256):
+        """Small blurred grayscale copy of image, used to compare consecutive frames cheaply"""
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        height = int(round(gray.shape[0] * width / gray.shape[1]))
+        small = cv2.resize(gray, (width, height), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (5, 5), 0).astype(np.float32)
+
+    def frame_shift(previous_signature, signature):
+        """Estimated translation in pixels between two settle signatures (phase correlation)"""
+        window = cv2.createHanningWindow(signature.shape[::-1], cv2.CV_32F)
+        (dx, dy), response = cv2.phaseCorrelate(previous_signature, signature, window)
+        return float(np.hypot(dx, dy))
+
     def calculate_focus_score(image):
         image_filtered = cv2.GaussianBlur(image, (9, 9), 0)
         laplacian = cv2.Laplacian(image_filtered, cv2.CV_64F)
@@ -0,0 +1,128 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import cv2
+
+
+class Encoder_Pool:
+    """
+    A small, bounded set of threads that encode images for the HTTP routes.
+    Request threads hand a frame over and wait for the bytes, so no more than `workers`
+    encodes run at once however many requests arrive, leaving cores for capture, the
+    trace over and flake detection.
+    When the queue is full, queued live-stream jobs are dropped oldest first (their callers
+    get None and simply wait for the next frame); other jobs wait for room up to a timeout.
+    """
+    WORKERS = 2
+    MAX_QUEUE = 8
+    LATENCY_SAMPLES = 500
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """The process-wide pool, started on first use"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = Encoder_Pool()
+            return cls._shared
+
+    def __init__(self, workers: int = WORKERS, max_queue: int = MAX_QUEUE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.encode_times = deque(maxlen=Encoder_Pool.LATENCY_SAMPLES)
+        self.queue_times = deque(maxlen=Encoder_Pool.LATENCY_SAMPLES)
+        self.encoded_count = 0
+        self.dropped_count = 0
+        self.rejected_count = 0
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"encoder_{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, image, ext: str = ".jpg", params=None, live: bool = False, timeout: float = 5.0):
+        """Queue an encode and return a Future for the encoded bytes (None if dropped or failed).
+        Returns None if a non-live job could not be queued within timeout."""
+        future = Future()
+        job = (future, image, ext, params or [], live, time.time())
+        with self.condition:
+            while len(self.queue) >= self.max_queue:
+                oldest_live = next((queued for queued in self.queue if queued[4]), None)
+                if oldest_live is not None:
+                    self.queue.remove(oldest_live)
+                    self.dropped_count += 1
+                    oldest_live[0].set_result(None)
+                elif live or not self.condition.wait(timeout):
+                    self.rejected_count += 1
+                    return None
+            self.queue.append(job)
+            self.condition.notify_all()
+        return future
+
+    def encode(self, image, ext: str = ".jpg", params=None, live: bool = False, timeout: float = 5.0):
+        """Encode image on the pool and wait for the result. Returns bytes, or None if it was dropped or failed"""
+        future = self.submit(image, ext, params, live, timeout)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout)
+        except Exception as e:
+            print(f"Error waiting for encode: {e}")
+            return None
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                future, image, ext, params, live, queued_at = self.queue.popleft()
+                # Room in the queue for anyone waiting in submit
+                self.condition.notify_all()
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            started = time.time()
+            try:
+                ret, encoded = cv2.imencode(ext, image, params)
+                future.set_result(encoded.tobytes() if ret else None)
+            except Exception as e:
+                print(f"Error encoding image: {e}")
+                future.set_result(None)
+            finished = time.time()
+
+            with self.condition:
+                self.encoded_count += 1
+                self.queue_times.append(started - queued_at)
+                self.encode_times.append(finished - started)
+
+    @staticmethod
+    def percentiles_ms(samples):
+        """Mean, median and 99th percentile of durations in seconds, in milliseconds; shared by the other stats"""
+        if not samples:
+            return {"mean": None, "p50": None, "p99": None}
+        ordered = sorted(samples)
+        return {
+            "mean": round(1000 * sum(ordered) / len(ordered), 2),
+            "p50": round(1000 * ordered[len(ordered) // 2], 2),
+            "p99": round(1000 * ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 2),
+        }
+
+    def stats(self):
+        """Queue depth, counters and recent encode / queue-wait latencies in milliseconds"""
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "queue_depth": len(self.queue),
+                "max_queue": self.max_queue,
+                "encoded": self.encoded_count,
+                "dropped": self.dropped_count,
+                "rejected": self.rejected_count,
+                "encode_ms": Encoder_Pool.percentiles_ms(self.encode_times),
+                "queue_wait_ms": Encoder_Pool.percentiles_ms(self.queue_times),
+            }
@@ -0,0 +1,185 @@
+import threading
+import time
+import cv2
+import numpy as np
+from cv_functions import CV_Functions
+
+
+class Flake_Hunter:
+    """
+    Live flake highlighting for one camera.
+    A background thread runs the detector on a downscaled copy of the newest frame; frames that
+    arrive while it is busy are skipped. Viewers get the current frame at the same reduced
+    resolution with the latest detection drawn over it, so the overlay lags by at most one
+    detection while the picture itself stays live. The raw stream is untouched.
+    """
+    # Width frames are scaled to for detection and for the overlay stream
+    DETECT_WIDTH = 640
+    CONFIDENCE_THRESHOLD = 0.5
+    JPEG_QUALITY = 80
+    FPS = 15
+    COLORS = [(0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0)]
+
+    # camera_id -> Flake_Hunter
+    hunters = dict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, camera):
+        with cls._lock:
+            hunter = cls.hunters.get(camera.camera_id)
+            if hunter is None or hunter.camera is not camera:
+                hunter = Flake_Hunter(camera)
+                cls.hunters[camera.camera_id] = hunter
+            return hunter
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.lock = threading.Lock()
+        self.viewers = 0
+        self.thread = None
+
+        # Latest detection: flakes in DETECT_WIDTH coordinates and the frame they came from
+        self.flakes = []
+        self.result_id = 0
+        self.result_frame_id = 0
+        self.detect_ms = None
+        self.skipped_frames = 0
+
+        # Last rendered overlay, shared by every viewer
+        self.render_lock = threading.Lock()
+        self.rendered_key = None
+        self.rendered = None
+
+    def acquire(self):
+        """Register a viewer; detection runs while there is at least one"""
+        with self.lock:
+            self.viewers += 1
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._detect_loop, name=f"flake_hunter_{self.camera.camera_id}", daemon=True
+                )
+                self.thread.start()
+
+    def release(self):
+        with self.lock:
+            self.viewers = max(0, self.viewers - 1)
+
+    @staticmethod
+    def downscale(frame):
+        width = Flake_Hunter.DETECT_WIDTH
+        if frame.shape[1] <= width:
+            return frame.copy()
+        height = int(round(frame.shape[0] * width / frame.shape[1]))
+        return cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+
+    def _detect_loop(self):
+        last_frame_id = 0
+        try:
+            while self.camera.is_active:
+                with self.lock:
+                    if self.viewers == 0:
+                        # Cleared in the same locked block that decides to stop, so an acquire()
+                        # after this starts a new thread rather than relying on this one
+                        self.thread = None
+                        return
+                lease = self.camera.lease_frame(after_id=last_frame_id, timeout=1.0)
+                if lease is None:
+                    continue
+                with lease:
+                    if last_frame_id:
+                        self.skipped_frames += lease.frame_id - last_frame_id - 1
+                    last_frame_id = lease.frame_id
+                    full_width = lease.frame.shape[1]
+                    small = Flake_Hunter.downscale(lease.frame)
+
+                # The size threshold is an area in full resolution pixels
+                scale = small.shape[1] / full_width
+                size_threshold = max(1, int(CV_Functions.SIZE_THRESHOLD * scale * scale))
+                start = time.perf_counter()
+                flakes = CV_Functions.run_searching(small, size_threshold=size_threshold)
+                detect_ms = 1000 * (time.perf_counter() - start)
+
+                with self.lock:
+                    self.flakes = [
+                        flake for flake in flakes
+                        if (1 - flake.false_positive_probability) > Flake_Hunter.CONFIDENCE_THRESHOLD
+                    ]
+                    self.result_id += 1
+                    self.result_frame_id = last_frame_id
+                    self.detect_ms = detect_ms
+        except Exception as e:
+            print(f"Error in flake hunter for camera {self.camera.camera_id}: {e}")
+        finally:
+            # Stopped for another reason (camera closed, error); a thread started since is left alone
+            with self.lock:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def draw(self, frame, flakes, scale):
+        """Outline flakes (found at DETECT_WIDTH) on a frame of the same size"""
+        for idx, flake in enumerate(flakes):
+            color = Flake_Hunter.COLORS[idx % len(Flake_Hunter.COLORS)]
+            contour = cv2.morphologyEx(flake.mask, cv2.MORPH_GRADIENT, np.ones((3, 3), np.uint8))
+            frame[contour > 0] = color
+            area = flake.size / (scale * scale) * 0.3844**2
+            cv2.putText(frame, f"{flake.thickness}L {int(area)}um2",
+                        (int(flake.center[0]) + 8, int(flake.center[1])),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1)
+        status = f"{len(flakes)} flakes"
+        if self.detect_ms is not None:
+            status += f", detect {self.detect_ms:.0f} ms"
+        cv2.putText(frame, status, (8, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        return frame
+
+    def get_overlay_frame(self, after_id, timeout=1.0):
+        """Wait for a frame newer than after_id and return (frame_id, JPEG bytes) with the latest
+        detection drawn over it. Each (frame, detection) pair is rendered once for all viewers."""
+        lease = self.camera.lease_frame(after_id=after_id, timeout=timeout)
+        if lease is None:
+            return after_id, None
+        with lease, self.render_lock:
+            with self.lock:
+                flakes = self.flakes
+                result_id = self.result_id
+            key = (lease.frame_id, result_id)
+            if self.rendered_key != key:
+                frame = Flake_Hunter.downscale(lease.frame)
+                frame = self.draw(frame, flakes, frame.shape[1] / lease.frame.shape[1])
+                jpeg = self.camera.encode_jpeg(frame, Flake_Hunter.JPEG_QUALITY, live=True)
+                if jpeg is None:
+                    return lease.frame_id, None
+                self.rendered_key = key
+                self.rendered = jpeg
+            return lease.frame_id, self.rendered
+
+    def stats(self):
+        with self.lock:
+            return {
+                "viewers": self.viewers,
+                "detections": self.result_id,
+                "detect_ms": None if self.detect_ms is None else round(self.detect_ms, 1),
+                "skipped_frames": self.skipped_frames,
+                "result_frame_id": self.result_frame_id,
+            }
+
+    @staticmethod
+    def generate_video(camera):
+        """Multipart MJPEG generator of the overlay stream, like Camera.generate_video"""
+        hunter = Flake_Hunter.get(camera)
+        hunter.acquire()
+        last_frame_id = 0  # Frame ids start at 1, so this waits for the first frame
+        last_sent = 0.0
+        try:
+            while camera.is_active:
+                camera.throttle_stream(last_sent, Flake_Hunter.FPS)
+                frame_id, jpeg = hunter.get_overlay_frame(last_frame_id)
+                if jpeg is None:
+                    continue
+                last_frame_id = frame_id
+                last_sent = time.time()
+                yield camera.as_multipart(jpeg)
+        except Exception as e:
+            print(f"Error in flake hunt stream for camera {camera.camera_id}: {e}")
+        finally:
+            hunter.release()
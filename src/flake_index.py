@@ -0,0 +1,168 @@
+import os
+import sqlite3
+import threading
+
+
+class Flake_Index:
+    """
+    SQLite index of the images and flakes of one scan directory, kept next to metadata.json.
+    metadata.json stays the record of the scan; this holds the same flakes in indexed tables so
+    they can be filtered and ranked, and images looked up by position, without loading it.
+    """
+    FILE_NAME = "flake_index.sqlite"
+    # Pixel edge length in µm, as used for flake areas in CV_Functions.visualise_flakes
+    PIXEL_SIZE_UM = 0.3844
+    MAX_RESULTS = 500
+    ORDERS = {
+        "area": "f.area_um2 DESC",
+        "confidence": "f.confidence DESC",
+        "thickness": "f.thickness ASC, f.area_um2 DESC",
+        "position": "f.wafer_index, f.image_index, f.flake_index",
+    }
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS images (
+            wafer_index INTEGER NOT NULL,
+            image_index INTEGER NOT NULL,
+            wafer_id INTEGER,
+            image_id INTEGER,
+            name TEXT,
+            camera_id INTEGER,
+            x REAL,
+            y REAL,
+            PRIMARY KEY (wafer_index, image_index)
+        );
+        CREATE TABLE IF NOT EXISTS flakes (
+            wafer_index INTEGER NOT NULL,
+            image_index INTEGER NOT NULL,
+            flake_index INTEGER NOT NULL,
+            thickness NUMERIC,
+            size REAL,
+            area_um2 REAL,
+            confidence REAL,
+            center_x REAL,
+            center_y REAL,
+            stage_x REAL,
+            stage_y REAL,
+            mask TEXT,
+            PRIMARY KEY (wafer_index, image_index, flake_index)
+        );
+        CREATE INDEX IF NOT EXISTS flakes_thickness_area ON flakes (thickness, area_um2);
+        CREATE INDEX IF NOT EXISTS flakes_confidence ON flakes (confidence);
+        CREATE INDEX IF NOT EXISTS flakes_area ON flakes (area_um2);
+    """
+
+    # directory -> Flake_Index, so the server opens each index once
+    _open = dict()
+    _open_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, directory: str):
+        """The shared index of a scan directory (the full path), created if needed"""
+        directory = os.path.abspath(directory)
+        with cls._open_lock:
+            index = cls._open.get(directory)
+            if index is None:
+                index = Flake_Index(os.path.join(directory, Flake_Index.FILE_NAME))
+                cls._open[directory] = index
+            return index
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        # Inline search results are recorded from the search pool's thread
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(Flake_Index.SCHEMA)
+
+    def image_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+    def _image_row(self, wafer_index, image_index, image):
+        return (wafer_index, image_index, image.get("wafer_id"), image.get("image_id"), image.get("name"),
+                image.get("camera_id"), image.get("x"), image.get("y"))
+
+    def _flake_rows(self, wafer_index, image_index, image):
+        rows = []
+        for flake_index, flake in enumerate(image.get("flakes", [])):
+            center = flake.get("center") or [None, None]
+            rows.append((
+                wafer_index, image_index, flake_index,
+                flake.get("thickness"),
+                flake.get("size"),
+                flake.get("size") * Flake_Index.PIXEL_SIZE_UM**2 if flake.get("size") is not None else None,
+                1 - flake["false_positive_probability"] if flake.get("false_positive_probability") is not None else None,
+                center[0], center[1],
+                image.get("x"), image.get("y"),
+                flake.get("mask"),
+            ))
+        return rows
+
+    def add_image(self, wafer_index: int, image_index: int, image: dict):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    self._image_row(wafer_index, image_index, image))
+
+    def set_flakes(self, wafer_index: int, image_index: int, image: dict):
+        """Replace the indexed flakes of an image with those in its metadata"""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    self._image_row(wafer_index, image_index, image))
+            self.connection.execute("DELETE FROM flakes WHERE wafer_index = ? AND image_index = ?",
+                                    (wafer_index, image_index))
+            self.connection.executemany(
+                "INSERT INTO flakes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                self._flake_rows(wafer_index, image_index, image)
+            )
+
+    def rebuild(self, metadata: dict):
+        """Replace the index contents with everything in metadata (for scans made before it existed)"""
+        images = []
+        flakes = []
+        for wafer_index, wafer in enumerate(metadata.get("wafers", [])):
+            for image_index, image in enumerate(wafer):
+                images.append(self._image_row(wafer_index, image_index, image))
+                flakes += self._flake_rows(wafer_index, image_index, image)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM flakes")
+            self.connection.execute("DELETE FROM images")
+            self.connection.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?)", images)
+            self.connection.executemany("INSERT INTO flakes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", flakes)
+
+    def image(self, wafer_index: int, image_index: int):
+        """The indexed metadata of one image as a dict, or None"""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM images WHERE wafer_index = ? AND image_index = ?", (wafer_index, image_index)
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def query(self, min_thickness=None, max_thickness=None, min_area=None, max_area=None,
+              min_confidence=None, wafer_index=None, order_by="area", limit=MAX_RESULTS):
+        """Flakes matching every given bound, best first by order_by (see ORDERS).
+        Areas are in µm², confidence is 1 - false positive probability."""
+        conditions = []
+        parameters = []
+        for clause, value in (("f.thickness >= ?", min_thickness), ("f.thickness <= ?", max_thickness),
+                              ("f.area_um2 >= ?", min_area), ("f.area_um2 <= ?", max_area),
+                              ("f.confidence >= ?", min_confidence), ("f.wafer_index = ?", wafer_index)):
+            if value is not None:
+                conditions.append(clause)
+                parameters.append(value)
+        sql = ("SELECT f.*, i.wafer_id, i.image_id, i.name AS image_name FROM flakes f "
+               "JOIN images i ON i.wafer_index = f.wafer_index AND i.image_index = f.image_index")
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {Flake_Index.ORDERS.get(order_by, Flake_Index.ORDERS['area'])} LIMIT ?"
+        parameters.append(min(int(limit), Flake_Index.MAX_RESULTS))
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
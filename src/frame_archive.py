@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+import numpy as np
+
+
+class Frame_Archive:
+    """
+    Raw frames of one wafer appended to a single file, frames.raw, with an index of where each
+    frame starts. Reading a frame back is a memory map of its bytes rather than a PNG decode, so
+    search workers re-searching a scan read tiles without copying them, sharing the pages through
+    the OS cache. Frames start on page boundaries; the index, frames.index, is one JSON line per
+    frame and is only written once the frame's bytes are in the file.
+    """
+    FILE_NAME = "frames.raw"
+    INDEX_NAME = "frames.index"
+    ALIGNMENT = 4096
+
+    # directory -> Frame_Archive, so every container of a scan appends through one object
+    _open = dict()
+    _open_lock = threading.Lock()
+
+    @classmethod
+    def for_directory(cls, directory: str):
+        directory = os.path.abspath(directory)
+        with cls._open_lock:
+            archive = cls._open.get(directory)
+            if archive is None:
+                archive = Frame_Archive(directory)
+                cls._open[directory] = archive
+            return archive
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, Frame_Archive.FILE_NAME)
+        self.index_path = os.path.join(directory, Frame_Archive.INDEX_NAME)
+        self.lock = threading.Lock()
+        self.index = dict()  # frame name -> {"offset", "shape", "dtype"}
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        with open(self.index_path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Cut short by a crash
+                if entry["offset"] + Frame_Archive.frame_bytes(entry) <= size:
+                    self.index[entry["name"]] = entry
+
+    @staticmethod
+    def frame_bytes(entry):
+        return int(np.prod(entry["shape"])) * np.dtype(entry["dtype"]).itemsize
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def append(self, name: str, frame: np.ndarray):
+        """Add a frame to the end of the archive"""
+        frame = np.ascontiguousarray(frame)
+        with self.lock:
+            with open(self.path, "ab") as f:
+                end = f.tell()
+                offset = -(-end // Frame_Archive.ALIGNMENT) * Frame_Archive.ALIGNMENT
+                f.write(b"\0" * (offset - end))
+                f.write(memoryview(frame).cast("B"))
+            entry = {"name": name, "offset": offset, "shape": list(frame.shape), "dtype": frame.dtype.str}
+            with open(self.index_path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+            self.index[name] = entry
+
+    def source(self, name: str):
+        """Everything a worker process needs to map a frame, or None if it is not archived"""
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        return {"archive": self.path, "offset": entry["offset"], "shape": entry["shape"], "dtype": entry["dtype"]}
+
+    def read(self, name: str):
+        """Read-only memory mapped view of a frame, or None if it is not archived"""
+        source = self.source(name)
+        return Frame_Archive.map(source) if source is not None else None
+
+    @staticmethod
+    def map(source: dict):
+        """Map a frame described by source() without reading it"""
+        return np.memmap(source["archive"], dtype=np.dtype(source["dtype"]), mode="r",
+                         offset=source["offset"], shape=tuple(source["shape"]))
@@ -0,0 +1,147 @@
+import threading
+import time
+
+
+class Frame_Lease:
+    """
+    A read-only hold on one slot of a Frame_Ring.
+    The capture thread will not write into the slot until the lease is released, so
+    the frame can be read without copying it. Use it as a context manager or call release().
+    """
+
+    def __init__(self, ring, slot, frame_id, timestamp):
+        self.ring = ring
+        self.slot = slot
+        self.frame = ring.slots[slot]
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+
+    def release(self):
+        if self.ring is not None:
+            self.ring._release(self.slot)
+            self.ring = None
+            self.frame = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+
+class Frame_Ring:
+    """
+    Fixed number of frame buffers that the capture thread reads into in place.
+    Buffers are allocated by the first read into each slot and reused after that, so a
+    running camera does not allocate a new full frame per capture. Every committed frame
+    gets a sequence id and a capture timestamp.
+    """
+    DEFAULT_SIZE = 8
+
+    def __init__(self, size: int = DEFAULT_SIZE):
+        self.size = size
+        self.slots = [None] * size
+        self.slot_ids = [0] * size  # 0 means the slot holds no readable frame
+        self.slot_timestamps = [0.0] * size
+        self.leases = [0] * size
+        self.latest_slot = -1
+        self.latest_id = 0
+        self.latest_timestamp = None
+        self.closed = False
+        self.dropped_frames = 0
+        self.condition = threading.Condition()
+        self._next_slot = 0
+
+    # Writer side (capture thread only)
+    def begin_write(self):
+        """Claim the oldest unleased slot. Returns (slot, buffer); buffer is None until first use.
+        Returns (-1, None) when every slot is leased."""
+        with self.condition:
+            for step in range(self.size):
+                slot = (self._next_slot + step) % self.size
+                if self.leases[slot] == 0 and slot != self.latest_slot:
+                    self._next_slot = (slot + 1) % self.size
+                    self.slot_ids[slot] = 0
+                    return slot, self.slots[slot]
+            self.dropped_frames += 1
+            return -1, None
+
+    def commit(self, slot: int, frame, timestamp: float = None):
+        """Publish the frame read into slot. frame replaces the buffer if the read reallocated it"""
+        with self.condition:
+            if slot < 0:
+                return self.latest_id
+            self.slots[slot] = frame
+            self.latest_id += 1
+            self.latest_slot = slot
+            self.latest_timestamp = timestamp if timestamp is not None else time.time()
+            self.slot_ids[slot] = self.latest_id
+            self.slot_timestamps[slot] = self.latest_timestamp
+            self.condition.notify_all()
+            return self.latest_id
+
+    def close(self):
+        """Drop all buffers and wake every waiter"""
+        with self.condition:
+            self.closed = True
+            self.slots = [None] * self.size
+            self.slot_ids = [0] * self.size
+            self.latest_slot = -1
+            self.condition.notify_all()
+
+    # Reader side
+    def _lease_locked(self, slot):
+        self.leases[slot] += 1
+        return Frame_Lease(self, slot, self.slot_ids[slot], self.slot_timestamps[slot])
+
+    def _release(self, slot):
+        with self.condition:
+            self.leases[slot] -= 1
+
+    def lease_latest(self):
+        """Lease the most recent frame, or None if nothing has been captured"""
+        with self.condition:
+            if self.latest_slot < 0:
+                return None
+            return self._lease_locked(self.latest_slot)
+
+    def wait_for_id(self, after_id: int, timeout: float = None) -> bool:
+        """Block until a frame newer than after_id is committed. False on timeout or close"""
+        with self.condition:
+            return self._wait_locked(after_id, timeout)
+
+    def _wait_locked(self, after_id, timeout):
+        self.condition.wait_for(lambda: self.latest_id > after_id or self.closed, timeout)
+        return self.latest_id > after_id and not self.closed
+
+    def lease_after(self, after_id: int = None, timeout: float = None):
+        """Lease the newest frame once one newer than after_id exists (after now if None)"""
+        with self.condition:
+            if after_id is None:
+                after_id = self.latest_id
+            # Ids start at 1: an id below that still waits for the first frame to be committed
+            if not self._wait_locked(max(after_id, 0), timeout) or self.latest_slot < 0:
+                return None
+            return self._lease_locked(self.latest_slot)
+
+    def lease_captured_after(self, timestamp: float, timeout: float = None):
+        """Lease the earliest frame still in the ring that was captured after timestamp,
+        waiting for one if needed. Returns None if the wait timed out."""
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while not self.closed:
+                candidates = [
+                    slot for slot in range(self.size)
+                    if self.slot_ids[slot] > 0 and self.slot_timestamps[slot] > timestamp
+                ]
+                if candidates:
+                    first = min(candidates, key=lambda slot: self.slot_ids[slot])
+                    return self._lease_locked(first)
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return None
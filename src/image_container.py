@@ -1,28 +1,53 @@
 import json
+import hashlib
 import numpy as np
 import os
+import time
+import threading
+import queue
 from datetime import datetime
-from multiprocessing import Pool
 import cv2
 import camera
 from transfer_station import Transfer_Station
 from cv_functions import CV_Functions
+from search_pool import Search_Pool
+from mask_store import Mask_Store
+from flake_index import Flake_Index
+from metadata_journal import Metadata_Journal
+from image_writer import Image_Writer
+from frame_archive import Frame_Archive
+from wafer_mosaic import Wafer_Mosaic
+from socket_manager import Socket_Manager
 import packet_handlers
-from GMMDetector.structures import Flake
 
 class Image_Container:
     """
     This class is used to store images.
     """
     IMAGE_REPO_NAME = "../images"
+    # Minimum seconds between SCAN_PROGRESS packets
+    PROGRESS_INTERVAL = 0.5
+    # Inline search: most captured frames in detection at once. A tile captured while all are busy is
+    # not queued (that would hold up the stage); it is searched from disk when the scan finishes.
+    INLINE_SEARCH_SLOTS = 4
+    # Flakes less likely than this to be real are left out of the mosaic's flake layer
+    MOSAIC_CONFIDENCE_THRESHOLD = 0.5
+    # Where captures are kept: PNG files, each wafer's Frame_Archive, or both
+    STORAGE_MODES = ("png", "archive", "both")
+    # Flakes less likely than this to be real are not drawn on the search output
+    RENDER_CONFIDENCE_THRESHOLD = 0.5
+    # Bump when the look of the search output changes, so every image is drawn again
+    RENDER_VERSION = 1
+    # Fingerprints of the search output drawn so far, in searched/
+    RENDER_MANIFEST = "renders.json"
 
     # Overloading constructors to handle different types of initialization
     # Other than the directory name all data is stored in the metadata.json file
     def __init__(self, transfer_station: Transfer_Station, directory: str = None):
         if directory is None:
-            self.directory = os.path.join(Image_Container.IMAGE_REPO_NAME, datetime.now().strftime('%d-%m-%Y-%H-%M-%S'))
-        else:
-            self.directory = os.path.join(Image_Container.IMAGE_REPO_NAME, directory)
+            directory = datetime.now().strftime('%d-%m-%Y-%H-%M-%S')
+        self.name = directory
+        self.directory = os.path.join(Image_Container.IMAGE_REPO_NAME, directory)
         os.makedirs(self.directory, exist_ok=True)
         self.transfer_station = transfer_station
         self.directory_images = os.path.join(self.directory, "images")
@@ -32,54 +57,121 @@ class Image_Container:
         os.makedirs(self.directory_searched, exist_ok=True)
         os.makedirs(self.directory_flake_masks, exist_ok=True)
 
-        metadata_path = os.path.join(self.directory, "metadata.json")
-        if os.path.exists(metadata_path):
-            with open(metadata_path, 'r') as f:
-                self.metadata = dict(json.load(f)) 
-        else:
-            self.metadata = dict()
-            self.metadata["wafers"] = []
-            self.metadata["searched"] = []
-            self.metadata["metametadata"] = []
+        # Changes are appended to metadata.journal as they happen and folded into metadata.json
+        # when a wafer, a scan or a search finishes, never while an image is being added
+        self.journal = Metadata_Journal(self.directory)
+        self.metadata = self.journal.load()
 
         self.wafer_counter = 0
         self.image_counter = 0
-        self.scanned_counter = 0
+
+        # Guards metadata against the inline search results arriving from the pool's thread
+        self.metadata_lock = threading.RLock()
+        self.inline_search = False
+        self.mask_stores = dict()  # wafer index -> Mask_Store used by this container (shared, see Mask_Store.for_path)
+        self.png_compression = Image_Writer.PNG_COMPRESSION
+        self.mosaic = None  # Wafer_Mosaic built while scanning, see enable_mosaic
+        self.storage = "png"  # One of STORAGE_MODES
+
+        # Queryable copy of the images and flakes; built from metadata.json for older scans
+        self.flake_index = Flake_Index.for_directory(self.directory)
+        if self.flake_index.image_count() != self.image_count():
+            self.flake_index.rebuild(self.metadata)
+
+        # Keyword arguments for CV_Functions.search_tile, see set_search_options
+        self.search_options = {}
+        self.reset_search_stats()
 
     def load_sent_data(self, data: dict):
-        self.metadata["metametadata"].append(data)
-        self.save_metadata()
+        self.record_event({"op": "metametadata", "data": data})
 
-    def add_image(self, camera_id: int):
+    def add_image(self, camera_id: int, captured_after: float = None):
+        """Capture and record a tile; captured_after is passed on to Camera.snap_image"""
         self.image_counter += 1
-        frame = camera.Camera.global_list[camera_id].snap_image()
-        image_name = f"{camera_id}-{datetime.now().strftime('%d-%m-%Y-%H-%M-%S')}.png"
+        frame = camera.Camera.global_list[camera_id].snap_image(captured_after)
+        # Several tiles can be captured within a second, so the name carries milliseconds and the
+        # tile's number on the wafer; names must be unique (files, archive index, mask ids, searched/)
+        now = datetime.now()
+        image_name = f"{camera_id}-{now.strftime('%d-%m-%Y-%H-%M-%S')}-{now.microsecond // 1000:03d}-{self.image_counter}.png"
         wafer_path = os.path.join(self.directory_images, f"wafer_{self.wafer_counter}")
         image_path = os.path.join(wafer_path, image_name)
-        cv2.imwrite(image_path, frame)
-        self.metadata["wafers"][-1].append({
-            "wafer_id": self.wafer_counter,
-            "name": image_name,
-            "camera_id": camera_id,
-            "image_id": self.image_counter,
-            "x": self.transfer_station.posX(),
-            "y": self.transfer_station.posY(),
-            "flakes": []
-        })
+        if self.storage != "png":
+            self.frame_archive(self.wafer_counter).append(image_name, frame)
+        if self.storage != "archive":
+            # Written in the background; the snapshot frame is never modified after it is taken
+            Image_Writer.shared().write(image_path, frame, Image_Writer.png_params(self.png_compression))
+        x = self.transfer_station.posX()
+        y = self.transfer_station.posY()
+        with self.metadata_lock:
+            self.record_event({
+                "op": "add_image",
+                "wafer": len(self.metadata["wafers"]) - 1,
+                "image": {
+                    "wafer_id": self.wafer_counter,
+                    "name": image_name,
+                    "camera_id": camera_id,
+                    "image_id": self.image_counter,
+                    "x": x,
+                    "y": y,
+                    "flakes": []
+                }
+            })
+            key = (len(self.metadata["wafers"]) - 1, len(self.metadata["wafers"][-1]) - 1)
+            self.flake_index.add_image(*key, self.metadata["wafers"][-1][-1])
 
-        self.save_metadata()
+        if self.mosaic is not None:
+            self.mosaic.add_image(key[0], image_name, frame, x, y)
+
+        if self.inline_search:
+            self.search_inline(key, frame)
+
+    def enable_mosaic(self, pixels_per_unit: float = None, field_of_view: float = None, register: bool = False):
+        """Stitch every image added from now on into the wafer mosaics, see Wafer_Mosaic"""
+        self.mosaic = Wafer_Mosaic(self.directory, pixels_per_unit, field_of_view, register)
+
+    def record_event(self, event: dict):
+        """Apply a metadata change and append it to the journal"""
+        with self.metadata_lock:
+            self.journal.append(self.metadata, event)
 
     def save_metadata(self):
-        metadata_path = os.path.join(self.directory, "metadata.json")
-        with open(metadata_path, 'w') as f:
-            json.dump(self.metadata, f) 
+        """Write the full metadata.json now (and empty the journal), and drop superseded flake masks"""
+        with self.metadata_lock:
+            for store in self.mask_stores.values():
+                store.compact()
+            self.journal.compact(self.metadata)
     
     def load_metadata(self, directory: str):
-        with open(f"{directory}/metadata.json", 'r') as f:
-            self.metadata = json.load(f)
+        """Replace the metadata with that of the scan in directory, its metadata.json plus its journal"""
+        metadata = Metadata_Journal(directory).load(repair=False)  # Read only, the journal is not ours
+        with self.metadata_lock:
+            self.metadata = metadata
+
+    def image_path(self, image_name: str, wafer_id: int):
+        return os.path.join(self.directory_images, f"wafer_{wafer_id}", image_name)
+
+    def set_storage(self, storage: str):
+        if storage not in Image_Container.STORAGE_MODES:
+            packet_handlers.PacketCommander.send_error(f"Unknown image storage {storage}, keeping {self.storage}")
+            return
+        self.storage = storage
+
+    def frame_archive(self, wafer_id: int):
+        """The Frame_Archive of one wafer's raw captures"""
+        return Frame_Archive.for_directory(os.path.join(self.directory_images, f"wafer_{wafer_id}"))
+
+    def image_source(self, image: dict):
+        """What a search worker reads an image from: its place in the wafer's archive if it has
+        one, so the frame is mapped instead of decoded, otherwise its PNG"""
+        source = self.frame_archive(image["wafer_id"]).source(image["name"])
+        return source if source is not None else self.image_path(image["name"], image["wafer_id"])
 
     def load_image(self, image_name: str, wafer_id: int):
-        image_path = os.path.join(self.directory_images, f"wafer_{wafer_id}", image_name)
+        # Read-only view of the archived frame; callers that draw on an image copy it first
+        frame = self.frame_archive(wafer_id).read(image_name)
+        if frame is not None:
+            return frame
+        image_path = self.image_path(image_name, wafer_id)
         try:
             if os.path.exists(image_path):
                 # Load image using OpenCV
@@ -96,8 +188,14 @@ class Image_Container:
             return None
 
     def new_wafer(self):
+        # Everything captured on the previous wafer is on disk before the next one starts
+        Image_Writer.shared().flush()
         self.wafer_counter += 1
-        self.metadata["wafers"].append([])
+        with self.metadata_lock:
+            # Wafer boundary: fold the last wafer's events into metadata.json
+            if self.journal.pending:
+                self.journal.compact(self.metadata)
+            self.record_event({"op": "new_wafer"})
         os.makedirs(os.path.join(self.directory_images, f"wafer_{self.wafer_counter}"), exist_ok=True)
         self.image_counter = 0
 
@@ -105,103 +203,432 @@ class Image_Container:
         self.search_images()
         self.generate_image_output()
 
-    def search_images(self):
-        self.wafer_counter = 0
-        for wafer in self.metadata["wafers"]:
-            self.scanned_counter = 0
-            self.wafer_counter += 1
-            # Running multithreaded pool to search images
-            packet_handlers.PacketCommander.send_message(f"Searching in wafer {self.wafer_counter}")
-            with Pool(5) as pool:
-                results = pool.map(self.search_image, wafer)
-            packet_handlers.PacketCommander.send_message(f"Finished Hunting wafer {self.wafer_counter}")
-            # Add flake data to each image in metadata
-            for image, flake_data in zip(wafer, results):
-                counter = 0
-                for flake in flake_data:
-                    mask_name = f"Wafer_{self.wafer_counter}-Image_{image['name']}-Flake_{counter}.png"
-                    counter += 1
-                    cv2.imwrite(os.path.join(self.directory_flake_masks, mask_name), flake.mask)
-                    image["flakes"].append(
-                        {
-                            "thickness": flake.thickness,
-                            "size": flake.size,
-                            "false_positive_probability": flake.false_positive_probability,
-                            "center": list(flake.center),
-                            "max_sidelength": flake.max_sidelength,
-                            "min_sidelength": flake.min_sidelength,
-                            "mean_contrast": flake.mean_contrast,
-                            "mask": mask_name
-                        })
-                if flake_data.any():
-                    # print(f"flake data is {flake_data}")
-                    self.metadata["searched"].append(image)
-                self.save_metadata()
-
-    def search_image(self, data):
-        image_name = data["name"]
-
-        image_data = self.load_image(image_name, data["wafer_id"])
-        # Run CV search
-        flake_data = CV_Functions.run_searching(image_data)
-        if flake_data.any():
-            print(f"Found {len(flake_data)} flakes in image {image_name}")
-        else:
-            print(f"No flakes found in image {image_name}")
-        self.update_scanned_counter(data["image_id"])
-        return flake_data
-
-    def update_scanned_counter(self, image_id):
-        if image_id > self.scanned_counter:
-            self.scanned_counter = image_id
-            print(f"Scanned counter is {self.scanned_counter} out of {len(self.metadata['wafers'][self.wafer_counter-1])}")
-
-    def generate_image_output(self):
-        for image_metadata in self.metadata.get("searched"):
-            image = self.load_image(image_metadata["name"], image_metadata["wafer_id"])
-            flakes = [
-                Flake(
-                    thickness=flake.get("thickness"),
-                    size=flake.get("size"), 
-                    false_positive_probability=flake.get("false_positive_probability"),
-                    center=flake.get("center"),
-                    mask=cv2.imread(os.path.join(self.directory_flake_masks, flake.get("mask")), cv2.IMREAD_GRAYSCALE),
-                    max_sidelength=flake.get("max_sidelength"),  # Default values for required parameters
-                    min_sidelength=flake.get("min_sidelength"),  # Default values for required parameters
-                    mean_contrast=flake.get("mean_contrast")  #
-                )
-                for flake in image_metadata.get("flakes", [])
+    def set_search_options(self, prescreen: bool = None, validate: bool = False):
+        """Turn the pre-screen on or off for this directory (None uses CV_Functions.PRESCREEN_ENABLED).
+        validate runs the detector on pre-screen rejects too and reports how many had flakes."""
+        self.search_options = {"prescreen": prescreen, "validate": validate}
+
+    def reset_search_stats(self):
+        self.search_stats = {"tiles": 0, "rejected": 0, "false_rejects": 0,
+                             "prescreen_ms": 0.0, "detect_ms": 0.0, "detected": 0}
+
+    def record_search_info(self, info):
+        """Add one tile's search_tile info to the running pre-screen statistics"""
+        if info is None:
+            return
+        with self.metadata_lock:
+            stats = self.search_stats
+            stats["tiles"] += 1
+            stats["rejected"] += info["rejected"]
+            stats["false_rejects"] += bool(info["false_reject"])
+            stats["prescreen_ms"] += info["prescreen_ms"] or 0.0
+            if info["detect_ms"] is not None:
+                stats["detected"] += 1
+                stats["detect_ms"] += info["detect_ms"]
+
+    def report_search_stats(self):
+        """Send the pre-screen rejection count, timings and, in validation mode, false-reject rate"""
+        stats = self.search_stats
+        if stats["tiles"] == 0 or self.search_options.get("prescreen") is False:
+            return
+        if stats["prescreen_ms"] == 0.0 and stats["rejected"] == 0:
+            return  # Pre-screen was not used
+        message = (f"Pre-screen rejected {stats['rejected']}/{stats['tiles']} tiles, "
+                   f"{stats['prescreen_ms'] / stats['tiles']:.1f} ms per tile")
+        if stats["detected"]:
+            message += f", detection {stats['detect_ms'] / stats['detected']:.1f} ms per tile"
+        if self.search_options.get("validate"):
+            rate = stats["false_rejects"] / stats["rejected"] if stats["rejected"] else 0.0
+            message += f", false rejects {stats['false_rejects']}/{stats['rejected']} ({100 * rate:.1f}%)"
+        print(message)
+        packet_handlers.PacketCommander.send_message(message)
+
+    def search_config(self):
+        """Fingerprint of the detector settings the current search options produce results with"""
+        prescreen = self.search_options.get("prescreen")
+        if self.search_options.get("validate"):
+            prescreen = False  # Validation keeps the detector's result for every tile
+        return CV_Functions.search_fingerprint(prescreen)
+
+    @staticmethod
+    def file_hash(path: str):
+        digest = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def search_record(self, wafer_index: int, image_index: int, config: str, content_hash: str = None):
+        """What an image's search result depends on: its file's content hash and the detector config.
+        The file's size and mtime are kept too, so an untouched file need not be hashed again.
+        Archived frames are never rewritten, so their offset in the archive stands for their content."""
+        image = self.metadata["wafers"][wafer_index][image_index]
+        source = self.frame_archive(image["wafer_id"]).source(image["name"])
+        if source is not None:
+            return {"archive_offset": source["offset"], "config": config}
+        path = self.image_path(image["name"], image["wafer_id"])
+        Image_Writer.shared().wait_for(path)  # Inline results can arrive before the capture is written
+        stat = os.stat(path)
+        return {
+            "hash": content_hash or Image_Container.file_hash(path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "config": config,
+        }
+
+    def needs_search(self, image: dict, config: str):
+        """False if image was searched with this config and its file has not changed since"""
+        record = image.get("search")
+        if not record or record.get("config") != config:
+            return True
+        source = self.frame_archive(image["wafer_id"]).source(image["name"])
+        if source is not None and record.get("archive_offset") == source["offset"]:
+            return False
+        if "hash" not in record:
+            return True
+        path = self.image_path(image["name"], image["wafer_id"])
+        try:
+            stat = os.stat(path)
+            if stat.st_size == record.get("size") and stat.st_mtime_ns == record.get("mtime_ns"):
+                return False
+            if Image_Container.file_hash(path) == record["hash"]:
+                # Touched but unchanged (copied, restored from backup)
+                record["size"] = stat.st_size
+                record["mtime_ns"] = stat.st_mtime_ns
+                return False
+        except OSError:
+            pass
+        return True
+
+    def search_images(self, force: bool = False):
+        """Search images for flakes on the shared worker pool, recording each result as it arrives.
+        Images already searched with the current detector config are skipped unless they changed
+        (or force is set), so a re-run only does new work and an interrupted search resumes."""
+        config = self.search_config()
+        total = self.image_count()
+        with self.metadata_lock:
+            tasks = [
+                ((wafer_index, image_index), self.image_source(image))
+                for wafer_index, wafer in enumerate(self.metadata["wafers"])
+                for image_index, image in enumerate(wafer)
+                if force or self.needs_search(image, config)
+            ]
+        packet_handlers.PacketCommander.send_message(
+            f"Searching {len(tasks)} images in {len(self.metadata['wafers'])} wafers"
+            f" ({total - len(tasks)} unchanged since the last search)"
+        )
+
+        done = 0
+        found = 0
+        last_progress = 0.0
+        self.reset_search_stats()
+        for (wafer_index, image_index), flake_data, error, info in Search_Pool.search(tasks, self.search_options):
+            done += 1
+            self.record_search_info(info)
+            image = self.metadata["wafers"][wafer_index][image_index]
+            if error is not None:
+                print(error)
+            else:
+                found += len(flake_data)
+                if len(flake_data) > 0:
+                    print(f"Found {len(flake_data)} flakes in image {image['name']}")
+                self.record_flakes(wafer_index, image_index, flake_data, config, info.get("hash"))
+
+            if done == len(tasks) or time.time() - last_progress > Image_Container.PROGRESS_INTERVAL:
+                last_progress = time.time()
+                self.send_progress("search", done, len(tasks), found)
+        self.save_metadata()
+        packet_handlers.PacketCommander.send_message(f"Finished searching, found {found} flakes")
+        self.report_search_stats()
+
+    def archive_images(self):
+        """Copy this scan's PNG captures into their wafers' frame archives, alongside the PNGs,
+        so later searches map the frames instead of decoding them"""
+        with self.metadata_lock:
+            images = [
+                image for wafer in self.metadata["wafers"] for image in wafer
+                if image["name"] not in self.frame_archive(image["wafer_id"])
             ]
-            image_data = CV_Functions.visualise_flakes(flakes, image, 0.5)
-            # Add wafer and position text
-            cv2.putText(
-                image_data,
-                f"Wafer: {image_metadata['wafer_id']}", 
-                (image_data.shape[1] - 300, 30),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2
-            )
-            cv2.putText(
-                image_data,
-                f"Image Number: {image_metadata['image_id']}", 
-                (image_data.shape[1] - 300, 60),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2
-            )
-            cv2.putText(
-                image_data,
-                f"x: {image_metadata['x']} y: {image_metadata['y']}", 
-                (image_data.shape[1] - 300, 90),
-                cv2.FONT_HERSHEY_SIMPLEX,
-                1,
-                (255, 255, 255),
-                2
-            )
-            cv2.imwrite(os.path.join(self.directory_searched, image_metadata["name"]), image_data)
+        archived = 0
+        last_progress = 0.0
+        for done, image in enumerate(images, 1):
+            frame = cv2.imread(self.image_path(image["name"], image["wafer_id"]))
+            if frame is None:
+                print(f"Failed to load image {image['name']}")
+            else:
+                self.frame_archive(image["wafer_id"]).append(image["name"], frame)
+                archived += 1
+            if done == len(images) or time.time() - last_progress > Image_Container.PROGRESS_INTERVAL:
+                last_progress = time.time()
+                self.send_progress("archive", done, len(images))
+        packet_handlers.PacketCommander.send_message(f"Archived {archived} of {len(images)} images in {self.name}")
+
+    def mask_store(self, wafer_index: int):
+        """The Mask_Store holding the flake masks of one wafer"""
+        with self.metadata_lock:
+            store = self.mask_stores.get(wafer_index)
+            if store is None:
+                store = Mask_Store.for_path(Mask_Store.wafer_path(self.directory_flake_masks, wafer_index))
+                self.mask_stores[wafer_index] = store
+            return store
+
+    def load_flake_mask(self, flake: dict):
+        """Full-frame mask of a recorded flake. Older scans kept one PNG per flake"""
+        mask_name = flake.get("mask")
+        if mask_name.endswith(".png"):
+            return cv2.imread(os.path.join(self.directory_flake_masks, mask_name), cv2.IMREAD_GRAYSCALE)
+        return self.mask_store(flake["mask_wafer"]).read(mask_name)
+
+    def record_flakes(self, wafer_index: int, image_index: int, flake_data, config: str = None, content_hash: str = None):
+        """Write the masks of the flakes found in an image and make them its search result in the
+        metadata and the flake index, replacing any earlier result"""
+        with self.metadata_lock:
+            self._record_flakes(wafer_index, image_index, flake_data, config or self.search_config(), content_hash)
+
+    def _record_flakes(self, wafer_index, image_index, flake_data, config, content_hash):
+        image = self.metadata["wafers"][wafer_index][image_index]
+        store = self.mask_store(wafer_index)
+        flakes = []
+        counter = 0
+        for flake in flake_data:
+            mask_name = f"Wafer_{wafer_index + 1}-Image_{image['name']}-Flake_{counter}"
+            counter += 1
+            store.write(mask_name, flake.mask)
+            flakes.append(
+                {
+                    "thickness": flake.thickness,
+                    "size": flake.size,
+                    "false_positive_probability": flake.false_positive_probability,
+                    "center": list(flake.center),
+                    "max_sidelength": flake.max_sidelength,
+                    "min_sidelength": flake.min_sidelength,
+                    "mean_contrast": flake.mean_contrast,
+                    "mask": mask_name,
+                    "mask_wafer": wafer_index
+                })
+        # Replaces the image's earlier flakes and "searched" entry; masks rewritten under the
+        # same ids replace the old ones in the store
+        self.record_event({
+            "op": "search_result",
+            "wafer": wafer_index,
+            "image": image_index,
+            "flakes": flakes,
+            "search": self.search_record(wafer_index, image_index, config, content_hash),
+        })
+        self.flake_index.set_flakes(wafer_index, image_index, image)
+        if self.mosaic is not None:
+            self.mosaic.add_flakes(wafer_index, image["name"], [
+                (flake.mask, flake.thickness) for flake in flake_data
+                if 1 - flake.false_positive_probability > Image_Container.MOSAIC_CONFIDENCE_THRESHOLD
+            ])
+
+    def start_inline_search(self):
+        """Search every image added from now on while the scan keeps running"""
+        self.inline_search = True
+        self.inline_slots = threading.Semaphore(Image_Container.INLINE_SEARCH_SLOTS)
+        self.inline_condition = threading.Condition()
+        self.inline_outstanding = 0
+        self.inline_searched = 0
+        self.inline_found = 0
+        self.inline_skipped = []  # (wafer index, image index) captured while detection was busy
+        self.inline_config = self.search_config()
+        self.reset_search_stats()
+        # Results are recorded on a thread of their own: the pool delivers every result (of all
+        # searches) on one thread, which must not wait for the writer, hashing or the journal
+        self.inline_results = queue.Queue()
+        self.inline_recorder = threading.Thread(target=self._record_inline_results, name="inline_recorder", daemon=True)
+        self.inline_recorder.start()
+
+    def search_inline(self, key, frame):
+        """Hand a captured frame to the search pool without blocking the caller"""
+        if not self.inline_slots.acquire(blocking=False):
+            self.inline_skipped.append(key)
+            return
+        with self.inline_condition:
+            self.inline_outstanding += 1
+        Search_Pool.search_frame(key, frame, self._inline_result, self.search_options)
+
+    def _inline_result(self, result):
+        """Called on the pool's result thread; hands the result to the recorder thread"""
+        self.inline_results.put(result)
+
+    def _record_inline_results(self):
+        while True:
+            result = self.inline_results.get()
+            if result is None:
+                return
+            (wafer_index, image_index), flake_data, error, info = result
+            try:
+                self.record_search_info(info)
+                if error is not None:
+                    print(error)
+                    self.inline_skipped.append((wafer_index, image_index))
+                else:
+                    self.record_flakes(wafer_index, image_index, flake_data, self.inline_config)
+                    self.inline_found += len(flake_data)
+            except Exception as e:
+                # Searched again from disk when the scan finishes
+                print(f"Error recording inline search result: {e}")
+                self.inline_skipped.append((wafer_index, image_index))
+            finally:
+                # The slot is held until the result is recorded, which bounds the flake masks waiting here
+                self.inline_slots.release()
+                with self.inline_condition:
+                    self.inline_outstanding -= 1
+                    self.inline_searched += 1
+                    self.inline_condition.notify_all()
+            self.send_progress("inline", self.inline_searched, self.image_count(), self.inline_found)
+
+    def finish_inline_search(self):
+        """Wait for detections still running, then search the tiles that were skipped while it was busy"""
+        if not self.inline_search:
+            return
+        self.inline_search = False
+        with self.inline_condition:
+            self.inline_condition.wait_for(lambda: self.inline_outstanding == 0)
+        self.inline_results.put(None)
+        self.inline_recorder.join()
+
+        skipped = list(self.inline_skipped)
+        if skipped:
+            packet_handlers.PacketCommander.send_message(f"Searching {len(skipped)} images skipped during the scan")
+            tasks = []
+            for wafer_index, image_index in skipped:
+                image = self.metadata["wafers"][wafer_index][image_index]
+                tasks.append(((wafer_index, image_index), self.image_source(image)))
+            for (wafer_index, image_index), flake_data, error, info in Search_Pool.search(tasks, self.search_options):
+                self.record_search_info(info)
+                if error is not None:
+                    print(error)
+                    continue
+                self.record_flakes(wafer_index, image_index, flake_data, self.inline_config, info.get("hash"))
+                self.inline_found += len(flake_data)
+        packet_handlers.PacketCommander.send_message(
+            f"Inline search finished: {self.inline_found} flakes, {len(skipped)} images searched after the scan"
+        )
+        self.report_search_stats()
+
+    def image_count(self):
+        return sum(len(wafer) for wafer in self.metadata["wafers"])
+
+    def send_progress(self, stage: str, done: int, total: int, found: int = 0):
+        """Tell the UI how far a search or render of this directory has got"""
+        Socket_Manager.send_all_json({
+            "type": "SCAN_PROGRESS",
+            "directory": self.name,
+            "stage": stage,
+            "done": done,
+            "total": total,
+            "found": found,
+        })
+
+    def render_job(self, image: dict, confidence_threshold: float):
+        """(fingerprint, job) for drawing the search output of a searched image, see Search_Pool.render.
+        The fingerprint covers everything the drawing depends on: the source image's version, the
+        flakes confident enough to be drawn, the caption and RENDER_VERSION."""
+        source = self.image_source(image)
+        if isinstance(source, dict):
+            version = ["archive", source["offset"]]
+        else:
+            Image_Writer.shared().wait_for(source)
+            stat = os.stat(source)
+            version = [stat.st_size, stat.st_mtime_ns]
+        flakes = [
+            flake for flake in image.get("flakes", [])
+            if 1 - flake.get("false_positive_probability", 1) > confidence_threshold
+        ]
+        caption = [
+            f"Wafer: {image['wafer_id']}",
+            f"Image Number: {image['image_id']}",
+            f"x: {image['x']} y: {image['y']}",
+        ]
+        fingerprint = hashlib.sha1(json.dumps(
+            [Image_Container.RENDER_VERSION, version, flakes, caption], sort_keys=True
+        ).encode()).hexdigest()
+        flake_jobs = []
+        for flake in flakes:
+            mask_source = self.flake_mask_source(flake)
+            if mask_source is None:
+                print(f"No stored mask for flake {flake.get('mask')}, not drawing it")
+                continue
+            flake_jobs.append(dict(flake, mask_source=mask_source))
+        job = {
+            "source": source,
+            "flakes": flake_jobs,
+            "caption": caption,
+            "confidence_threshold": confidence_threshold,
+            "output": os.path.join(self.directory_searched, image["name"]),
+        }
+        return fingerprint, job
+
+    def flake_mask_source(self, flake: dict):
+        """What a render worker rebuilds a flake's mask from: a legacy mask PNG's path or the stored crop"""
+        mask_name = flake.get("mask")
+        if mask_name.endswith(".png"):
+            return os.path.join(self.directory_flake_masks, mask_name)
+        return self.mask_store(flake["mask_wafer"]).read_crop(mask_name)
+
+    def generate_image_output(self, confidence_threshold: float = RENDER_CONFIDENCE_THRESHOLD, force: bool = False):
+        """Draw the flakes found in each searched image into searched/ on the worker pool.
+        An image is drawn again only if something it is drawn from changed since it was last drawn
+        (the fingerprints are kept in searched/renders.json), unless force is set; outputs of
+        images no longer searched are removed."""
+        manifest_path = os.path.join(self.directory_searched, Image_Container.RENDER_MANIFEST)
+        rendered = dict()
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, "r") as f:
+                    rendered = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"Drawing every image, could not read {manifest_path}: {e}")
+
+        tasks = []
+        fingerprints = dict()
+        with self.metadata_lock:
+            searched = list(self.metadata.get("searched"))
+        for image in searched:
+            try:
+                fingerprint, job = self.render_job(image, confidence_threshold)
+            except Exception as e:
+                print(f"Cannot draw {image['name']}: {e}")
+                continue
+            fingerprints[image["name"]] = fingerprint
+            if force or rendered.get(image["name"]) != fingerprint or not os.path.exists(job["output"]):
+                rendered.pop(image["name"], None)
+                tasks.append((image["name"], job))
+
+        # Only outputs of images that are no longer searched go; one that could not be prepared this
+        # time (a transient read error) keeps its output and manifest entry
+        searched_names = {image["name"] for image in searched}
+        for name in set(rendered) - searched_names:
+            try:
+                os.remove(os.path.join(self.directory_searched, name))
+            except OSError:
+                pass
+            del rendered[name]
+        packet_handlers.PacketCommander.send_message(
+            f"Drawing {len(tasks)} of {len(searched)} searched images ({len(searched) - len(tasks)} unchanged)"
+        )
+
+        done = 0
+        failed = 0
+        last_progress = 0.0
+        for name, error in Search_Pool.render(tasks):
+            done += 1
+            if error is not None:
+                print(error)
+                failed += 1
+            else:
+                rendered[name] = fingerprints[name]
+            if done == len(tasks) or time.time() - last_progress > Image_Container.PROGRESS_INTERVAL:
+                last_progress = time.time()
+                self.send_progress("render", done, len(tasks))
+
+        temporary_path = manifest_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(rendered, f)
+        os.replace(temporary_path, manifest_path)
+        packet_handlers.PacketCommander.send_message(f"Drew {done - failed} images, {failed} failed")
 
     def show_images(self):
         for image in self.metadata["searched"]:
@@ -0,0 +1,149 @@
+import os
+import threading
+import time
+from collections import deque
+import cv2
+from encoder_pool import Encoder_Pool
+
+
+class Image_Writer:
+    """
+    Writes captured frames to disk on background threads so the trace over does not wait for
+    PNG compression. write() queues the frame and returns at once; it only blocks when the
+    frames waiting to be written would use more than MAX_QUEUE_BYTES of memory.
+    flush() waits for everything queued and fsyncs it, for wafer and scan boundaries.
+    Queued frames are written as they are, so callers must not modify a frame after handing it over.
+    """
+    WORKERS = 2
+    # OpenCV's scale: 0 (fastest, largest files) to 9 (slowest, smallest)
+    PNG_COMPRESSION = 1
+    MAX_QUEUE_BYTES = 1 << 30
+    LATENCY_SAMPLES = 500
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """The process-wide writer, started on first use"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = Image_Writer()
+            return cls._shared
+
+    def __init__(self, workers: int = WORKERS, max_queue_bytes: int = MAX_QUEUE_BYTES):
+        self.workers = workers
+        self.max_queue_bytes = max_queue_bytes
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.queued_bytes = 0
+        self.pending = dict()  # path -> writes of it queued or in progress
+        self.unsynced = []  # paths written since the last flush
+        self.write_times = deque(maxlen=Image_Writer.LATENCY_SAMPLES)
+        self.written_count = 0
+        self.failed_count = 0
+        self.blocked_seconds = 0.0
+        self.threads = [
+            threading.Thread(target=self._worker, name=f"image_writer_{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @staticmethod
+    def png_params(compression: int = PNG_COMPRESSION):
+        return [cv2.IMWRITE_PNG_COMPRESSION, min(9, max(0, int(compression)))]
+
+    def write(self, path: str, frame, params=None):
+        """Queue frame to be written to path (format from the extension)"""
+        size = frame.nbytes
+        with self.condition:
+            if self.queued_bytes > 0 and self.queued_bytes + size > self.max_queue_bytes:
+                started = time.time()
+                self.condition.wait_for(lambda: self.queued_bytes == 0 or self.queued_bytes + size <= self.max_queue_bytes)
+                self.blocked_seconds += time.time() - started
+            self.queue.append((path, frame, params or []))
+            self.queued_bytes += size
+            self.pending[path] = self.pending.get(path, 0) + 1
+            self.condition.notify_all()
+
+    def _worker(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                path, frame, params = self.queue.popleft()
+
+            started = time.time()
+            try:
+                if not cv2.imwrite(path, frame, params):
+                    raise IOError("cv2.imwrite returned False")
+                written = True
+            except Exception as e:
+                print(f"Error writing image {path}: {e}")
+                written = False
+            finished = time.time()
+
+            with self.condition:
+                self.queued_bytes -= frame.nbytes
+                self.pending[path] -= 1
+                if self.pending[path] == 0:
+                    del self.pending[path]
+                if written:
+                    self.written_count += 1
+                    self.unsynced.append(path)
+                else:
+                    self.failed_count += 1
+                self.write_times.append(finished - started)
+                self.condition.notify_all()
+
+    def wait_for(self, path: str, timeout: float = None):
+        """Wait until no write of path is queued or running. False on timeout"""
+        with self.condition:
+            return self.condition.wait_for(lambda: path not in self.pending, timeout)
+
+    def flush(self, fsync: bool = True):
+        """Wait for every queued write, then fsync the files written since the last flush and their directories"""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending)
+            paths = self.unsynced
+            self.unsynced = []
+        if not fsync:
+            return
+        directories = set()
+        for path in paths:
+            try:
+                # Opened for writing: on Windows fsync (FlushFileBuffers) fails on a read-only handle
+                descriptor = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+                try:
+                    os.fsync(descriptor)
+                finally:
+                    os.close(descriptor)
+                directories.add(os.path.dirname(path) or ".")
+            except OSError as e:
+                print(f"Error syncing {path}: {e}")
+        if hasattr(os, "O_DIRECTORY"):  # Directories cannot be opened for fsync on Windows
+            for directory in directories:
+                try:
+                    descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(descriptor)
+                    finally:
+                        os.close(descriptor)
+                except OSError as e:
+                    print(f"Error syncing {directory}: {e}")
+
+    def stats(self):
+        """Queue depth and memory, counters and recent write latencies in milliseconds"""
+        with self.condition:
+            return {
+                "workers": self.workers,
+                "queue_depth": len(self.queue),
+                "in_progress": sum(self.pending.values()) - len(self.queue),
+                "queued_mb": round(self.queued_bytes / (1 << 20), 1),
+                "max_queue_mb": round(self.max_queue_bytes / (1 << 20), 1),
+                "written": self.written_count,
+                "failed": self.failed_count,
+                "blocked_seconds": round(self.blocked_seconds, 3),
+                "write_ms": Encoder_Pool.percentiles_ms(self.write_times),
+            }
@@ -7,6 +7,7 @@ import ctypes
 from socket_manager import Socket_Manager
 from camera import Camera
 import web_server
+from async_web_server import Async_Web_Server
 from cv_functions import CV_Functions
 from packet_handlers import PacketHandlers
 from transfer_functions import Transfer_Functions
@@ -44,16 +45,24 @@ if __name__ == "__main__":
     cv_functions = CV_Functions()
     print("Model Loaded")
     
-    print("Initializing Flask server")
-    flask_server_thread = threading.Thread(target=web_server.startup_flask_app)
-    flask_server_thread.daemon = True
-    flask_server_thread.start()
+    # "flask" (default): Flask serves the camera routes from its own threads.
+    # "asyncio": the camera routes are served from the websocket server's event loop.
+    server_mode = config.get('server_mode', 'flask')
+    extra_servers = []
+    if server_mode == "asyncio":
+        print("Serving camera routes from the websocket event loop")
+        extra_servers.append(Async_Web_Server.serve)
+    else:
+        print("Initializing Flask server")
+        flask_server_thread = threading.Thread(target=web_server.startup_flask_app)
+        flask_server_thread.daemon = True
+        flask_server_thread.start()
 
 
 
     print("Starting socket")
     # Use the new integrated method to start WebSocket server with transfer station
-    socket_manager_thread = threading.Thread(target=Socket_Manager.start_with_ts, args=(TRANSFER_STATION,))
+    socket_manager_thread = threading.Thread(target=Socket_Manager.start_with_ts, args=(TRANSFER_STATION, extra_servers))
     socket_manager_thread.daemon = True
     socket_manager_thread.start()
 
@@ -62,7 +71,8 @@ if __name__ == "__main__":
     # ts_sending_thread.daemon = True
     # ts_sending_thread.start()
 
-    print(f"System initialized with {len(Camera.global_list)} cameras: {list(Camera.global_list.keys())}")
+    camera_ids = [camera.camera_id for camera in Camera.cameras()]
+    print(f"System initialized with {len(camera_ids)} cameras: {camera_ids}")
     print("Press Enter to exit...")
     input()
 
@@ -0,0 +1,182 @@
+import os
+import struct
+import threading
+import numpy as np
+
+
+class Mask_Store:
+    """
+    All flake masks of one wafer in a single append-only file.
+    Each record holds a flake id, the flake's bounding box within the frame, and the box's
+    pixels bit-packed (1 bit per pixel), so a mask costs a few hundred bytes instead of a
+    full-frame PNG. The id -> offset index is rebuilt from the record headers when the file
+    is opened, so a mask can be read back by flake id with a single seek.
+    Rewriting a flake's mask appends a new record; compact() drops the records superseded so.
+    """
+    EXTENSION = ".masks"
+    MAGIC = b"FMSK"
+    # magic, id length, mask value, x, y, width, height, frame height, frame width, payload length
+    HEADER = struct.Struct("<4sHBIIIIIII")
+    # compact() rewrites the file once superseded records make up this share of it
+    COMPACT_FRACTION = 0.25
+
+    # path -> Mask_Store, so every container of a scan reads and writes through one index
+    _open = dict()
+    _open_lock = threading.Lock()
+
+    @classmethod
+    def for_path(cls, path: str):
+        path = os.path.abspath(path)
+        with cls._open_lock:
+            store = cls._open.get(path)
+            if store is None:
+                store = Mask_Store(path)
+                cls._open[path] = store
+            return store
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = dict()  # flake id -> offset of its record
+        self.end = 0  # end of the last record indexed
+        self.superseded_bytes = 0  # records replaced by a later record of the same id
+        self.lengths = dict()  # offset -> record length
+        self._reader = None
+        self._load_index()
+
+    @staticmethod
+    def wafer_path(directory: str, wafer_index: int):
+        return os.path.join(directory, f"Wafer_{wafer_index + 1}{Mask_Store.EXTENSION}")
+
+    def _load_index(self, repair: bool = True):
+        """Index the record headers after self.end. A record cut short by a crash is dropped from
+        the end of the file if repair is set; otherwise (it may still be being written) it is
+        left to a later call."""
+        if not os.path.exists(self.path):
+            return
+        end = self.end
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while end + Mask_Store.HEADER.size <= size:
+                f.seek(end)
+                header = Mask_Store.HEADER.unpack(f.read(Mask_Store.HEADER.size))
+                if header[0] != Mask_Store.MAGIC:
+                    break
+                id_length, payload_length = header[1], header[-1]
+                record_end = end + Mask_Store.HEADER.size + id_length + payload_length
+                if record_end > size:
+                    break
+                flake_id = f.read(id_length).decode("utf-8")
+                self._index_record(flake_id, end, record_end - end)
+                end = record_end
+        self.end = end
+        if end < size and repair:
+            print(f"Truncating damaged mask store {self.path} at {end} of {size} bytes")
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+
+    def _index_record(self, flake_id, offset, length):
+        if flake_id in self.index:
+            self.superseded_bytes += self._record_length(self.index[flake_id])
+        self.index[flake_id] = offset
+        self.lengths[offset] = length
+
+    def write(self, flake_id: str, mask: np.ndarray):
+        """Append the mask of one flake (a full-frame array, nonzero inside the flake)"""
+        frame_height, frame_width = mask.shape[:2]
+        ys, xs = np.nonzero(mask)
+        if len(xs) == 0:
+            x = y = width = height = 0
+            payload = b""
+            value = 0
+        else:
+            x, y = int(xs.min()), int(ys.min())
+            width, height = int(xs.max()) - x + 1, int(ys.max()) - y + 1
+            crop = mask[y:y + height, x:x + width] > 0
+            payload = np.packbits(crop, axis=None).tobytes()
+            value = int(mask[ys[0], xs[0]])
+        name = flake_id.encode("utf-8")
+        header = Mask_Store.HEADER.pack(Mask_Store.MAGIC, len(name), value, x, y, width, height,
+                                        frame_height, frame_width, len(payload))
+        record = header + name + payload
+        with self.lock:
+            with open(self.path, "ab") as f:
+                offset = f.tell()
+                f.write(record)
+            self._index_record(flake_id, offset, len(record))
+            self.end = offset + len(record)
+
+    def _record_length(self, offset):
+        return self.lengths.pop(offset, 0)
+
+    def ids(self):
+        """Flake ids in the order they were written"""
+        with self.lock:
+            return sorted(self.index, key=self.index.get)
+
+    def __contains__(self, flake_id):
+        return flake_id in self.index
+
+    def read_crop(self, flake_id: str):
+        """(x, y, boolean crop, frame shape, mask value) of a flake's bounding box, or None if it is not stored"""
+        with self.lock:
+            offset = self.index.get(flake_id)
+            if offset is None:
+                # Written by another process since the index was read
+                self._load_index(repair=False)
+                offset = self.index.get(flake_id)
+            if offset is None:
+                return None
+            if self._reader is None:
+                self._reader = open(self.path, "rb")
+            self._reader.seek(offset)
+            header = Mask_Store.HEADER.unpack(self._reader.read(Mask_Store.HEADER.size))
+            magic, id_length, value, x, y, width, height, frame_height, frame_width, payload_length = header
+            self._reader.seek(id_length, os.SEEK_CUR)
+            payload = self._reader.read(payload_length)
+        bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=width * height)
+        return x, y, bits.reshape(height, width).astype(bool), (frame_height, frame_width), value
+
+    def read(self, flake_id: str):
+        """The full-frame uint8 mask of a flake, as it was written, or None if it is not stored"""
+        crop = self.read_crop(flake_id)
+        return Mask_Store.expand(crop) if crop is not None else None
+
+    @staticmethod
+    def expand(crop):
+        """The full-frame uint8 mask of a read_crop() result"""
+        x, y, pixels, shape, value = crop
+        mask = np.zeros(shape, dtype=np.uint8)
+        mask[y:y + pixels.shape[0], x:x + pixels.shape[1]][pixels] = value
+        return mask
+
+    def compact(self):
+        """Rewrite the file with only the current record of each flake, if enough of it is
+        superseded records. The new file replaces the old one atomically."""
+        with self.lock:
+            if self.superseded_bytes <= self.end * Mask_Store.COMPACT_FRACTION:
+                return
+            if self._reader is not None:
+                self._reader.close()  # Windows cannot replace a file that is open
+                self._reader = None
+            temporary_path = self.path + ".tmp"
+            index = dict()
+            lengths = dict()
+            with open(self.path, "rb") as source, open(temporary_path, "wb") as target:
+                for flake_id, offset in sorted(self.index.items(), key=lambda item: item[1]):
+                    source.seek(offset)
+                    index[flake_id] = target.tell()
+                    lengths[target.tell()] = self.lengths[offset]
+                    target.write(source.read(self.lengths[offset]))
+                target.flush()
+                os.fsync(target.fileno())
+                end = target.tell()
+            os.replace(temporary_path, self.path)
+            print(f"Compacted mask store {self.path} from {self.end} to {end} bytes")
+            self.index, self.lengths, self.end, self.superseded_bytes = index, lengths, end, 0
+
+    def close(self):
+        with self.lock:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
@@ -0,0 +1,126 @@
+import json
+import os
+
+
+class Metadata_Journal:
+    """
+    Append-only record of the changes to a scan's metadata.
+    Every change is an event written as one JSON line to metadata.journal, so recording an
+    image costs the same however large the scan is. compact() writes the whole metadata to
+    metadata.json (still the file other tools read) and empties the journal; loading reads
+    metadata.json and replays the events written after it.
+
+    Events:
+        {"op": "metametadata", "data": {...}}           trace over parameters
+        {"op": "new_wafer"}
+        {"op": "add_image", "wafer": i, "image": {...}}
+        {"op": "search_result", "wafer": i, "image": j, "flakes": [...], "search": {...}}
+    """
+    FILE_NAME = "metadata.journal"
+    SNAPSHOT_NAME = "metadata.json"
+
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, Metadata_Journal.FILE_NAME)
+        self.snapshot_path = os.path.join(directory, Metadata_Journal.SNAPSHOT_NAME)
+        self.sequence = 0  # number of the last event written
+        self.pending = 0  # events in the journal since the last snapshot
+        self._file = None
+
+    @staticmethod
+    def empty():
+        return {"wafers": [], "searched": [], "metametadata": []}
+
+    @staticmethod
+    def apply(metadata: dict, event: dict):
+        """Apply one event to metadata in place"""
+        op = event["op"]
+        if op == "metametadata":
+            metadata["metametadata"].append(event["data"])
+        elif op == "new_wafer":
+            metadata["wafers"].append([])
+        elif op == "add_image":
+            metadata["wafers"][event["wafer"]].append(event["image"])
+        elif op == "search_result":
+            image = metadata["wafers"][event["wafer"]][event["image"]]
+            image["flakes"] = event["flakes"]
+            image["search"] = event["search"]
+            metadata["searched"] = [
+                searched for searched in metadata["searched"]
+                if (searched.get("wafer_id"), searched.get("name")) != (image["wafer_id"], image["name"])
+            ]
+            if image["flakes"]:
+                metadata["searched"].append(image)
+        else:
+            print(f"Unknown metadata event {op}")
+
+    def load(self, repair: bool = True):
+        """The metadata as of the last event written: the snapshot plus the journal's later events.
+        Readers that do not own the scan pass repair=False, so a line still being written is
+        skipped rather than cut off."""
+        metadata = Metadata_Journal.empty()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "r") as f:
+                metadata = dict(json.load(f))
+        self.sequence = metadata.pop("journal_sequence", 0)
+
+        if os.path.exists(self.path):
+            if repair:
+                self._drop_torn_tail()
+            with open(self.path, "r") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last line can be cut short by a crash
+                        if repair:
+                            print(f"Skipping damaged line in {self.path}")
+                        continue
+                    # Events already in the snapshot (compaction stopped before emptying the journal)
+                    if event["seq"] <= self.sequence:
+                        continue
+                    Metadata_Journal.apply(metadata, event)
+                    self.sequence = event["seq"]
+                    self.pending += 1
+        return metadata
+
+    def _drop_torn_tail(self):
+        """Cut a last line left unfinished by a crash, so the next event starts on a line of its own"""
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                print(f"Dropping unfinished last line of {self.path}")
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def append(self, metadata: dict, event: dict):
+        """Apply event to metadata and record it in the journal"""
+        Metadata_Journal.apply(metadata, event)
+        self.sequence += 1
+        event["seq"] = self.sequence
+        if self._file is None:
+            self._file = open(self.path, "a")
+        self._file.write(json.dumps(event) + "\n")
+        self._file.flush()
+        self.pending += 1
+
+    def compact(self, metadata: dict):
+        """Write metadata.json and empty the journal. The snapshot is replaced atomically and
+        records the last event it contains, so a crash at any point loses nothing."""
+        snapshot = dict(metadata)
+        snapshot["journal_sequence"] = self.sequence
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        open(self.path, "w").close()
+        self.pending = 0
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
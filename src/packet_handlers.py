@@ -6,7 +6,11 @@ import threading
 import transfer_functions
 from threading import Thread
 from image_container import Image_Container
+from flake_index import Flake_Index
+from wafer_mosaic import Wafer_Mosaic
+import os
 from socket_manager import Socket_Manager
+from cv_functions import CV_Functions
 # Dictionary to store packet handlers
 _handlers: Dict[str, Callable] = {}
 def packet_handler(packet_type: str):
@@ -125,23 +129,121 @@ class PacketHandlers:
     @packet_handler("SCAN_FLAKES")
     def handle_scan_flakes(packet_type: str, data: dict):
         directory = data.get("directory")
-        image_container = Image_Container(PacketHandlers.transfer_station, directory)
-        PacketCommander.send_message(f"Scanning flakes in {directory}")
-        image_container.search_images()
-        Socket_Manager.send_all_json({
-            "type": "SCAN_FLAKES_RESPONSE",
-            "response": "Scan completed"
-        })
+
+        # Search off the socket thread so progress packets reach the UI while it runs
+        def scan():
+            try:
+                image_container = Image_Container(PacketHandlers.transfer_station, directory)
+                image_container.set_search_options(data.get("prescreen"), data.get("validate_prescreen", False))
+                PacketCommander.send_message(f"Scanning flakes in {directory}")
+                image_container.search_images(force=data.get("force", False))
+                Socket_Manager.send_all_json({
+                    "type": "SCAN_FLAKES_RESPONSE",
+                    "response": "Scan completed"
+                })
+            except Exception as e:
+                PacketCommander.send_error(f"Scan error: {str(e)}")
+
+        thread = Thread(target=scan)
+        thread.daemon = True
+        thread.start()
 
     @packet_handler("DRAW_FLAKES")
     def handle_draw_flakes(packet_type: str, data: dict):
         directory = data.get("directory")
-        image_container = Image_Container(PacketHandlers.transfer_station, directory)
-        image_container.generate_image_output()
-        Socket_Manager.send_all_json({
-            "type": "DRAW_FLAKES_RESPONSE",
-            "response": "Wafers drawn",
-        })
+
+        # Drawn off the socket thread so progress packets reach the UI while it runs
+        def draw():
+            try:
+                image_container = Image_Container(PacketHandlers.transfer_station, directory)
+                image_container.generate_image_output(
+                    float(data.get("confidence_threshold", Image_Container.RENDER_CONFIDENCE_THRESHOLD)),
+                    force=data.get("force", False),
+                )
+                Socket_Manager.send_all_json({
+                    "type": "DRAW_FLAKES_RESPONSE",
+                    "response": "Wafers drawn",
+                })
+            except Exception as e:
+                PacketCommander.send_error(f"Draw error: {str(e)}")
+
+        thread = Thread(target=draw)
+        thread.daemon = True
+        thread.start()
+
+    @packet_handler("BUILD_MOSAIC")
+    def handle_build_mosaic(packet_type: str, data: dict):
+        directory = data.get("directory")
+
+        def build():
+            try:
+                image_container = Image_Container(PacketHandlers.transfer_station, directory)
+                # The step size of the trace over that made the scan, unless a calibration is given
+                trace_over = (image_container.metadata["metametadata"] or [{}])[-1]
+                magnification = int(trace_over.get("magnification", 20))
+                field_of_view = PacketHandlers.transfer_station.MAGNIFICATION_TRAVEL.get(magnification, {}).get("x")
+                PacketCommander.send_message(f"Building wafer mosaics for {directory}")
+                Wafer_Mosaic.build(image_container, data.get("pixelsPerUnit"), field_of_view, bool(data.get("register", False)))
+                PacketCommander.send_message(f"Wafer mosaics for {directory} built")
+            except Exception as e:
+                PacketCommander.send_error(f"Mosaic error: {str(e)}")
+
+        thread = Thread(target=build)
+        thread.daemon = True
+        thread.start()
+
+    @packet_handler("ARCHIVE_FRAMES")
+    def handle_archive_frames(packet_type: str, data: dict):
+        directory = data.get("directory")
+
+        def archive():
+            try:
+                Image_Container(PacketHandlers.transfer_station, directory).archive_images()
+            except Exception as e:
+                PacketCommander.send_error(f"Archive error: {str(e)}")
+
+        thread = Thread(target=archive)
+        thread.daemon = True
+        thread.start()
+
+    @packet_handler("RELOAD_DETECTORS")
+    def handle_reload_detectors(packet_type: str, data: dict):
+        material = data.get("material")
+        dropped = CV_Functions.reload_detectors(material)
+        PacketCommander.send_message(f"Reloaded contrast dictionaries, {dropped} detectors will be rebuilt")
+
+    @packet_handler("QUERY_FLAKES")
+    def handle_query_flakes(packet_type: str, data: dict):
+        directory = data.get("directory")
+
+        # Off the socket thread: an older scan's index is built from metadata.json first
+        def query():
+            try:
+                if not os.path.exists(os.path.join(Image_Container.IMAGE_REPO_NAME, directory, Flake_Index.FILE_NAME)):
+                    # Scan from before the index existed: opening the container builds it
+                    Image_Container(PacketHandlers.transfer_station, directory)
+                flake_index = Flake_Index.for_directory(os.path.join(Image_Container.IMAGE_REPO_NAME, directory))
+                results = flake_index.query(
+                    min_thickness=data.get("minThickness"),
+                    max_thickness=data.get("maxThickness"),
+                    min_area=data.get("minArea"),
+                    max_area=data.get("maxArea"),
+                    min_confidence=data.get("minConfidence"),
+                    wafer_index=data.get("waferNumber"),
+                    order_by=data.get("orderBy", "area"),
+                    limit=data.get("limit", Flake_Index.MAX_RESULTS),
+                )
+                Socket_Manager.send_all_json({
+                    "type": "QUERY_FLAKES_RESPONSE",
+                    "directory": directory,
+                    "flakes": results,
+                })
+            except Exception as e:
+                PacketCommander.send_error(f"Query error: {str(e)}")
+
+        thread = Thread(target=query)
+        thread.daemon = True
+        thread.start()
 
     @packet_handler("GOTO_WAFER_IMAGE")
     def handle_goto_wafer_image(packet_type: str, data: dict):
@@ -153,16 +255,30 @@ class PacketHandlers:
         topRightYOffset = data.get("topRightYOffset")
         waferNumber = data.get("waferNumber")
         imageNumber = data.get("imageNumber")
-        image_container = Image_Container(PacketHandlers.transfer_station, directory)
-        image_data = image_container.metadata.get("wafers")[waferNumber][imageNumber]
-        x = image_data["x"]
-        y = image_data["y"]
-        PacketCommander.send_message(f"Goto wafer {waferNumber} image {imageNumber} at {x}, {y}")
-        PacketCommander.send_message(f"Bottom Left Offset: ({bottomLeftXOffset}, {bottomLeftYOffset})")
-        PacketCommander.send_message(f"Top Right Offset: ({topRightXOffset}, {topRightYOffset})")
-        
-        # Move to the position with the bottom left offset
-        PacketHandlers.transfer_station.moveXY(x + bottomLeftXOffset, y + bottomLeftYOffset)
+
+        # Off the socket thread: the fallback parses metadata.json and builds the index
+        def goto():
+            try:
+                # Look the image up in the flake index instead of parsing metadata.json on every click
+                image_data = Flake_Index.for_directory(os.path.join(Image_Container.IMAGE_REPO_NAME, directory)).image(waferNumber, imageNumber)
+                if image_data is None:
+                    # Not indexed yet: opening the container builds the index from metadata.json
+                    image_container = Image_Container(PacketHandlers.transfer_station, directory)
+                    image_data = image_container.metadata.get("wafers")[waferNumber][imageNumber]
+                x = image_data["x"]
+                y = image_data["y"]
+                PacketCommander.send_message(f"Goto wafer {waferNumber} image {imageNumber} at {x}, {y}")
+                PacketCommander.send_message(f"Bottom Left Offset: ({bottomLeftXOffset}, {bottomLeftYOffset})")
+                PacketCommander.send_message(f"Top Right Offset: ({topRightXOffset}, {topRightYOffset})")
+
+                # Move to the position with the bottom left offset
+                PacketHandlers.transfer_station.moveXY(x + bottomLeftXOffset, y + bottomLeftYOffset)
+            except Exception as e:
+                PacketCommander.send_error(f"Goto wafer image error: {str(e)}")
+
+        thread = Thread(target=goto)
+        thread.daemon = True
+        thread.start()
 
     @packet_handler("ACK")
     def handle_ack(packet_type: str, data: dict):
@@ -0,0 +1,184 @@
+import glob
+import os
+import threading
+import cv2
+from frame_archive import Frame_Archive
+from metadata_journal import Metadata_Journal
+from wafer_mosaic import Wafer_Mosaic
+
+
+class Scan_Browser:
+    """
+    Read-only view of the scans under Image_Container.IMAGE_REPO_NAME for the browsing routes:
+    lists of scans, wafers and images from each scan's metadata, and JPEG thumbnails of captures
+    ("image") and rendered search output ("searched") at a few fixed widths.
+    Thumbnails are made on first request and cached under <scan>/thumbnails/, named after the
+    version of their source (its mtime, or its offset in the frame archive), so a changed source
+    gets a new thumbnail. Listings give each image's version; thumbnail requests that carry it
+    (?v=) can be cached by the client indefinitely.
+    """
+    THUMBNAIL_SIZES = (128, 256, 512)
+    JPEG_QUALITY = 80
+    KINDS = ("image", "searched")
+    REDUCED_READS = {128: cv2.IMREAD_REDUCED_COLOR_8, 256: cv2.IMREAD_REDUCED_COLOR_4, 512: cv2.IMREAD_REDUCED_COLOR_2}
+
+    # scan directory -> (metadata file versions, metadata)
+    _metadata = dict()
+    _metadata_lock = threading.Lock()
+
+    @staticmethod
+    def metadata(scan_directory: str):
+        """The metadata of a scan, read again only when metadata.json or the journal has changed"""
+        journal = Metadata_Journal(scan_directory)
+        version = tuple(
+            (stat.st_mtime_ns, stat.st_size) if stat else None
+            for stat in (Scan_Browser._stat(journal.snapshot_path), Scan_Browser._stat(journal.path))
+        )
+        if version == (None, None):
+            return None
+        with Scan_Browser._metadata_lock:
+            cached = Scan_Browser._metadata.get(scan_directory)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+        metadata = journal.load(repair=False)  # The scan may still be writing the journal
+        with Scan_Browser._metadata_lock:
+            Scan_Browser._metadata[scan_directory] = (version, metadata)
+        return metadata
+
+    @staticmethod
+    def _stat(path: str):
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    @staticmethod
+    def scans():
+        """Every scan directory with metadata, newest first"""
+        from image_container import Image_Container  # Imported here so the web servers do not load the scanning code at start
+        scans = []
+        for name in os.listdir(Image_Container.IMAGE_REPO_NAME) if os.path.isdir(Image_Container.IMAGE_REPO_NAME) else []:
+            scan_directory = Wafer_Mosaic.scan_path(name)
+            metadata = Scan_Browser.metadata(scan_directory) if os.path.isdir(scan_directory) else None
+            if metadata is None:
+                continue
+            scans.append({
+                "name": name,
+                "modified": os.path.getmtime(scan_directory),
+                "wafers": len(metadata["wafers"]),
+                "images": sum(len(wafer) for wafer in metadata["wafers"]),
+                "searched": len(metadata["searched"]),
+            })
+        scans.sort(key=lambda scan: scan["modified"], reverse=True)
+        return scans
+
+    @staticmethod
+    def wafers(directory: str):
+        """Summary of each wafer of the scan named directory, or None if there is no such scan"""
+        scan_directory = Wafer_Mosaic.scan_path(directory)
+        metadata = Scan_Browser.metadata(scan_directory) if scan_directory else None
+        if metadata is None:
+            return None
+        return [
+            {
+                "wafer_index": wafer_index,
+                "wafer_id": wafer[0]["wafer_id"] if wafer else None,
+                "images": len(wafer),
+                "searched": sum(1 for image in wafer if "search" in image),
+                "flakes": sum(len(image.get("flakes", [])) for image in wafer),
+            }
+            for wafer_index, wafer in enumerate(metadata["wafers"])
+        ]
+
+    @staticmethod
+    def images(directory: str, wafer_index: int, offset: int = 0, limit: int = None):
+        """The images of one wafer with their thumbnail versions, or None if there is no such wafer"""
+        scan_directory = Wafer_Mosaic.scan_path(directory)
+        metadata = Scan_Browser.metadata(scan_directory) if scan_directory else None
+        if metadata is None or not 0 <= wafer_index < len(metadata["wafers"]):
+            return None
+        wafer = metadata["wafers"][wafer_index]
+        end = len(wafer) if limit is None else offset + limit
+        return [
+            {
+                "image_index": image_index,
+                "name": image["name"],
+                "image_id": image.get("image_id"),
+                "x": image.get("x"),
+                "y": image.get("y"),
+                "flakes": len(image.get("flakes", [])),
+                "versions": {
+                    kind: Scan_Browser._source(scan_directory, image, kind)[1] for kind in Scan_Browser.KINDS
+                },
+            }
+            for image_index, image in enumerate(wafer[offset:end], offset)
+        ]
+
+    @staticmethod
+    def _source(scan_directory: str, image: dict, kind: str):
+        """(what a thumbnail of image is made from, its version), or (None, None) if it does not exist.
+        The source is a path, or a Frame_Archive.source() dict for an archived capture."""
+        if kind == "image":
+            wafer_directory = os.path.join(scan_directory, "images", f"wafer_{image['wafer_id']}")
+            archived = Frame_Archive.for_directory(wafer_directory).source(image["name"])
+            if archived is not None:
+                return archived, archived["offset"]
+            path = os.path.join(wafer_directory, image["name"])
+        else:
+            path = os.path.join(scan_directory, "searched", image["name"])
+        stat = Scan_Browser._stat(path)
+        return (path, stat.st_mtime_ns) if stat else (None, None)
+
+    @staticmethod
+    def thumbnail(directory: str, wafer_index: int, name: str, kind: str, size: int):
+        """(path of the cached JPEG thumbnail, version of its source), or None if there is no such image.
+        The thumbnail is made if it is not cached for the source's current version."""
+        scan_directory = Wafer_Mosaic.scan_path(directory)
+        metadata = Scan_Browser.metadata(scan_directory) if scan_directory else None
+        if metadata is None or kind not in Scan_Browser.KINDS or size not in Scan_Browser.THUMBNAIL_SIZES:
+            return None
+        if not 0 <= wafer_index < len(metadata["wafers"]):
+            return None
+        image = next((image for image in metadata["wafers"][wafer_index] if image["name"] == name), None)
+        if image is None:
+            return None
+        source, version = Scan_Browser._source(scan_directory, image, kind)
+        if source is None:
+            return None
+
+        stem = os.path.splitext(name)[0]
+        cache_directory = os.path.join(scan_directory, "thumbnails", kind, str(size), f"wafer_{wafer_index}")
+        path = os.path.join(cache_directory, f"{stem}_{version:x}.jpg")
+        if os.path.exists(path):
+            return path, version
+
+        frame = Scan_Browser._load(source, size)
+        if frame is None:
+            return None
+        height, width = frame.shape[:2]
+        if width > size:
+            frame = cv2.resize(frame, (size, max(1, round(height * size / width))), interpolation=cv2.INTER_AREA)
+        success, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, Scan_Browser.JPEG_QUALITY])
+        if not success:
+            return None
+        os.makedirs(cache_directory, exist_ok=True)
+        for stale in glob.glob(os.path.join(glob.escape(cache_directory), f"{glob.escape(stem)}_*.jpg")):
+            if os.path.basename(stale).rsplit("_", 1)[0] == stem:
+                os.remove(stale)
+        # Written under a temporary name so a concurrent request never serves half a file
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(encoded.tobytes())
+        os.replace(temporary_path, path)
+        return path, version
+
+    @staticmethod
+    def _load(source, size: int):
+        if isinstance(source, dict):
+            return Frame_Archive.map(source)
+        # Decode at a reduced size where the reader supports it (captures are 2048 pixels across),
+        # falling back to the full image if that leaves fewer than size pixels
+        frame = cv2.imread(source, Scan_Browser.REDUCED_READS[size])
+        if frame is None or frame.shape[1] < size:
+            frame = cv2.imread(source)
+        return frame
@@ -0,0 +1,162 @@
+import atexit
+import hashlib
+import os
+import threading
+from multiprocessing import Pool
+import cv2
+import numpy as np
+from cv_functions import CV_Functions
+from frame_archive import Frame_Archive
+from mask_store import Mask_Store
+from GMMDetector.structures import Flake
+
+
+# Fingerprint of the detector config this worker process has built, see _sync_detectors
+_worker_config = None
+
+def _init_worker():
+    """Runs once in every worker process: build the detector before the first task arrives"""
+    global _worker_config
+    CV_Functions.preload_detectors()
+    _worker_config = Search_Pool.detector_config()
+
+def _sync_detectors(config):
+    """Rebuild this worker's detectors from disk if the server searches with a different config
+    (contrast dicts reloaded since the worker started)"""
+    global _worker_config
+    if config is not None and config != _worker_config:
+        CV_Functions.reload_detectors()
+        _worker_config = Search_Pool.detector_config()
+
+def _search_task(task):
+    """Worker side of a search. task is (key, source, search options, detector config); only these
+    cross the process boundary. source is an image path, or a Frame_Archive.source() dict for a
+    frame that is mapped straight out of its wafer's archive instead of decoded.
+    Returns (key, flakes, error message, search info); for a path, info["hash"] is the
+    SHA-1 of the file that was searched."""
+    key, image_path, options, config = task
+    try:
+        _sync_detectors(config)
+        if isinstance(image_path, dict):
+            flakes, info = CV_Functions.search_tile(Frame_Archive.map(image_path), **options)
+            return key, flakes, None, info
+        with open(image_path, "rb") as f:
+            data = f.read()
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return key, None, f"Failed to load image {image_path}", None
+        flakes, info = CV_Functions.search_tile(image, **options)
+        info["hash"] = hashlib.sha1(data).hexdigest()
+        return key, flakes, None, info
+    except Exception as e:
+        return key, None, f"Error searching {image_path}: {e}", None
+
+def _search_frame_task(key, frame, options, config):
+    """Worker side of an in-memory search; frame is an image that has not been read back from disk"""
+    try:
+        _sync_detectors(config)
+        flakes, info = CV_Functions.search_tile(frame, **options)
+        return key, flakes, None, info
+    except Exception as e:
+        return key, None, f"Error searching frame {key}: {e}", None
+
+def _render_task(task):
+    """Worker side of drawing the search output of one image. task is (key, job): job has the image's
+    "source" (as for _search_task), its "flakes" as recorded in the metadata, each with a "mask_source"
+    (the path of a legacy mask PNG, or a Mask_Store.read_crop() result), the "caption" lines, the
+    "confidence_threshold" and the "output" path. Returns (key, error message)."""
+    key, job = task
+    try:
+        source = job["source"]
+        image = Frame_Archive.map(source) if isinstance(source, dict) else cv2.imread(source)
+        if image is None:
+            return key, f"Failed to load image {source}"
+        flakes = []
+        for flake in job["flakes"]:
+            mask_source = flake["mask_source"]
+            if isinstance(mask_source, str):
+                mask = cv2.imread(mask_source, cv2.IMREAD_GRAYSCALE)
+            else:
+                mask = Mask_Store.expand(mask_source)
+            if mask is None:
+                continue
+            flakes.append(Flake(
+                thickness=flake.get("thickness"),
+                size=flake.get("size"),
+                false_positive_probability=flake.get("false_positive_probability"),
+                center=flake.get("center"),
+                mask=mask,
+                max_sidelength=flake.get("max_sidelength"),
+                min_sidelength=flake.get("min_sidelength"),
+                mean_contrast=flake.get("mean_contrast"),
+            ))
+        image_data = CV_Functions.visualise_flakes(flakes, image, job["confidence_threshold"])
+        for line, text in enumerate(job["caption"]):
+            cv2.putText(image_data, text, (image_data.shape[1] - 300, 30 * (line + 1)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+        if not cv2.imwrite(job["output"], image_data):
+            return key, f"Failed to write {job['output']}"
+        return key, None
+    except Exception as e:
+        return key, f"Error drawing {key}: {e}"
+
+
+class Search_Pool:
+    """
+    Process pool for flake searching that lives as long as the server.
+    Workers are started once, with the detector already built, and reused by every scan;
+    they also draw the search output images.
+    Tasks carry paths (or archive offsets) and ids only, and results stream back in completion order.
+    """
+    # Leave one core for capture, the web server and the trace over
+    PROCESSES = max(1, (os.cpu_count() or 2) - 1)
+
+    _pool = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """The shared pool, started on first use"""
+        with cls._lock:
+            if cls._pool is None:
+                print(f"Starting flake search pool with {cls.PROCESSES} workers")
+                cls._pool = Pool(cls.PROCESSES, initializer=_init_worker)
+                atexit.register(cls.shutdown)
+            return cls._pool
+
+    @staticmethod
+    def detector_config():
+        """Fingerprint of the contrast dict and thresholds the detectors of this process are built from"""
+        return CV_Functions.search_fingerprint(prescreen=False)
+
+    @classmethod
+    def search(cls, tasks, options=None):
+        """Search (key, image path or archive source) tasks; yields (key, flakes, error, info) as each image finishes.
+        options are keyword arguments for CV_Functions.search_tile (prescreen, validate).
+        Workers built from a different detector config than this process rebuild theirs first."""
+        options = options or {}
+        config = cls.detector_config()
+        return cls.get().imap_unordered(
+            _search_task, ((key, path, options, config) for key, path in tasks), chunksize=1
+        )
+
+    @classmethod
+    def search_frame(cls, key, frame, callback, options=None):
+        """Search an in-memory frame without waiting for it. callback((key, flakes, error, info)) is
+        called from the pool's result thread when it finishes."""
+        def error_callback(e):
+            callback((key, None, f"Error searching frame {key}: {e}", None))
+        cls.get().apply_async(_search_frame_task, (key, frame, options or {}, cls.detector_config()),
+                              callback=callback, error_callback=error_callback)
+
+    @classmethod
+    def render(cls, tasks):
+        """Draw (key, job) tasks, see _render_task; yields (key, error) as each image is written"""
+        return cls.get().imap_unordered(_render_task, tasks, chunksize=1)
+
+    @classmethod
+    def shutdown(cls):
+        with cls._lock:
+            if cls._pool is not None:
+                cls._pool.terminate()
+                cls._pool = None
@@ -5,6 +5,7 @@ from queue import Queue
 import websockets
 from typing import Any, Dict, Callable
 import inspect
+from video_broadcast import Video_Broadcaster
 
 class Socket_Manager:
     """
@@ -12,6 +13,8 @@ class Socket_Manager:
     All you really have to know is that it has a queue of jsons that represent incoming messages and a function to send jsons to the clients.
     """
     CONNECTIONS = set()
+    # Event loop the server runs on, so other threads can hand it work
+    loop = None
 
 
     # Load packet definitions
@@ -21,6 +24,9 @@ class Socket_Manager:
     # Dictionary to store packet handlers
     packet_handlers: Dict[str, Callable] = dict()
 
+    # Binary video subscriptions: websocket -> {camera_id: (Frame_Slot, sending task)}
+    VIDEO_SUBSCRIPTIONS = dict()
+
     def start():
         """Start the WebSocket server and related tasks"""
         loop = asyncio.new_event_loop()
@@ -41,14 +47,17 @@ class Socket_Manager:
         loop.run_forever()
 
     @classmethod
-    def start_with_ts(cls, transfer_station):
-        """Start the WebSocket server with a transfer station for sending commands"""
+    def start_with_ts(cls, transfer_station, extra_servers=()):
+        """Start the WebSocket server with a transfer station for sending commands.
+        extra_servers are coroutine functions (e.g. Async_Web_Server.serve) started on the same loop."""
         loop = asyncio.new_event_loop()
         asyncio.set_event_loop(loop)
+        cls.loop = loop
         
         async def main():
             # Create the WebSocket server
             server = await serve(cls.conn_handler, "localhost", 8765)
+            servers = [server] + [await start_server() for start_server in extra_servers]
             
             # Start the sending thread as a task
             sending_task = asyncio.create_task(cls.ts_sending_thread(transfer_station))
@@ -57,7 +66,7 @@ class Socket_Manager:
             tasks = [sending_task]
             
             # Return the server and tasks for cleanup if needed
-            return server, tasks
+            return servers, tasks
         
         # Run the server forever
         loop.run_until_complete(main())
@@ -76,7 +85,7 @@ class Socket_Manager:
                 if isinstance(message, str):
                     # Text message
                     # print(f"Received message: {message}")
-                    Socket_Manager.handle_packet(message)
+                    Socket_Manager.handle_packet(message, websocket)
                 else:
                     print(f"Received unsupported message type: {type(message)}")
                     error_data = {
@@ -93,11 +102,12 @@ class Socket_Manager:
         except Exception as e:
             print(f"Socket error: {e}")
         finally:
+            Socket_Manager.unsubscribe_video(websocket)
             Socket_Manager.CONNECTIONS.remove(websocket)
             print(f"Connection removed {websocket}")
 
     @classmethod
-    def handle_packet(cls, message: str):
+    def handle_packet(cls, message: str, websocket=None):
         """Handle incoming packets"""
         try:
             # Parse the message as JSON safely
@@ -111,6 +121,14 @@ class Socket_Manager:
             if not packet_type:
                 raise ValueError("Packet missing 'type' field")
 
+            # Packets about this connection itself are handled here, everything else by the registered handlers
+            if packet_type == "SUBSCRIBE_VIDEO" and websocket is not None:
+                cls.subscribe_video(websocket, packet)
+                return
+            if packet_type == "UNSUBSCRIBE_VIDEO" and websocket is not None:
+                cls.unsubscribe_video(websocket, packet.get("camera"))
+                return
+
             # Call the appropriate handler
             handler = cls.packet_handlers.get(packet_type, cls.default_handler)
             handler(packet_type, packet)
@@ -173,6 +191,55 @@ class Socket_Manager:
 
     #     return True
 
+    @classmethod
+    def subscribe_video(cls, websocket, packet: dict):
+        """Start sending binary frames of packet["camera"] to this websocket.
+        Optional profile / width / quality / fps fields pick the stream profile, as on /video_feedN."""
+        import camera  # Imported here, camera imports this module
+        camera_id = int(packet["camera"])
+        if camera_id not in camera.Camera.global_list:
+            raise ValueError(f"Camera {camera_id} not found")
+        profile = camera.Camera.resolve_stream_profile(packet)
+
+        # Replace any existing subscription of this connection to the same camera
+        cls.unsubscribe_video(websocket, camera_id)
+        slot = Video_Broadcaster.subscribe(camera_id, profile)
+        task = asyncio.create_task(cls._send_video(websocket, camera_id, slot))
+        cls.VIDEO_SUBSCRIPTIONS.setdefault(websocket, dict())[camera_id] = (slot, task)
+        asyncio.create_task(cls._safe_send(websocket, json.dumps({
+            "type": "VIDEO_SUBSCRIBED",
+            "camera": camera_id,
+            "profile": profile,
+        })))
+
+    @classmethod
+    def unsubscribe_video(cls, websocket, camera_id=None):
+        """Stop sending frames of camera_id (every camera if None) to this websocket"""
+        subscriptions = cls.VIDEO_SUBSCRIPTIONS.get(websocket, dict())
+        camera_ids = list(subscriptions.keys()) if camera_id is None else [int(camera_id)]
+        for cid in camera_ids:
+            if cid in subscriptions:
+                slot, task = subscriptions.pop(cid)
+                Video_Broadcaster.unsubscribe(slot)
+        if not subscriptions:
+            cls.VIDEO_SUBSCRIPTIONS.pop(websocket, None)
+
+    @classmethod
+    async def _send_video(cls, websocket, camera_id: int, slot):
+        """Send the newest frame in slot whenever there is one; frames that arrive mid-send are skipped"""
+        try:
+            while True:
+                frame_id, jpeg = await slot.get()
+                if jpeg is None:
+                    break
+                await websocket.send(Video_Broadcaster.pack(camera_id, frame_id, jpeg))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"Error sending video to {websocket}: {e}")
+        finally:
+            Video_Broadcaster.unsubscribe(slot)
+
     @classmethod
     def default_handler(cls, packet_type: str, data: dict):
         """Default handler for unhandled packet types"""
@@ -206,17 +273,15 @@ class Socket_Manager:
         """Send JSON data to all connected clients"""
         try:
             msg = json.dumps(json_data)
-            # Get the current event loop or create a new one if none exists
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # Create and run the coroutine in the event loop
-            loop.call_soon_threadsafe(lambda: asyncio.create_task(cls._send_all_async(msg)))
         except Exception as e:
             print(f"Error serializing JSON: {e}")
+            return
+
+        # Safe from any thread: the send is scheduled on the server's own loop
+        loop = cls.loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(lambda: asyncio.create_task(cls._send_all_async(msg)))
 
     @classmethod
     async def _send_all_async(cls, msg: str):
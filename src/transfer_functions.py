@@ -4,6 +4,7 @@ import camera
 import threading
 import time
 from image_container import Image_Container
+from image_writer import Image_Writer
 # Dictionary containing travel distances for different magnifications (in micrometers)
 
 class Transfer_Functions:
@@ -22,9 +23,26 @@ class Transfer_Functions:
         packet_handlers.PacketCommander.send_message("Serializing a script to run trace over")
         image_container = Image_Container(Transfer_Functions.TRANSFER_STATION)
         image_container.load_sent_data(data)
+        image_container.png_compression = int(data.get("png_compression", Image_Writer.PNG_COMPRESSION))
+        # "archive" keeps raw frames in one file per wafer instead of PNGs, "both" keeps both
+        image_container.set_storage(data.get("storage", "png"))
 
         command_list = Transfer_Functions.generate_script(data, image_container)
+        if data.get("mosaic", False):
+            # Without a calibration, assume one step of the trace over spans one frame
+            magnification = int(data.get("magnification", 20))
+            image_container.enable_mosaic(
+                pixels_per_unit=data.get("mosaic_pixels_per_unit"),
+                field_of_view=Transfer_Functions.MAGNIFICATION_TRAVEL.get(magnification, {}).get("x"),
+                register=bool(data.get("mosaic_register", False)),
+            )
+        if data.get("inline_search", False):
+            # Search each tile for flakes as it is captured instead of in a separate pass afterwards
+            packet_handlers.PacketCommander.send_message("Inline flake search enabled")
+            image_container.set_search_options(data.get("prescreen"), data.get("validate_prescreen", False))
+            image_container.start_inline_search()
         packet_handlers.PacketCommander.send_message("Running trace over")
+        Transfer_Functions.TRANSFER_STATION.settle_times = []
 
         # Execute the command with the given parameters
         current_thread = threading.current_thread()
@@ -38,8 +56,37 @@ class Transfer_Functions:
             else:
                 break
         packet_handlers.PacketCommander.send_message("Trace over complete")
+        Transfer_Functions.report_settle_times()
+        # Scan boundary: every capture written and synced before searching and compacting metadata
+        Image_Writer.shared().flush()
+        writer_stats = Image_Writer.shared().stats()
+        packet_handlers.PacketCommander.send_message(
+            f"Images written: {writer_stats['written']} ({writer_stats['failed']} failed), "
+            f"median write {writer_stats['write_ms']['p50']} ms, capture blocked {writer_stats['blocked_seconds']}s on memory"
+        )
+        image_container.finish_inline_search()
+        if image_container.mosaic is not None:
+            image_container.mosaic.catch_up(image_container)
+        # Fold the scan's metadata journal into metadata.json
+        image_container.save_metadata()
         del Transfer_Functions.executing_threads[current_thread]
 
+    def capture_after_wait(capture, *args):
+        """Call capture (add_image or snap_image) with the first frame captured after the last wait ended"""
+        return capture(*args, captured_after=Transfer_Functions.TRANSFER_STATION.settled_at)
+
+    def report_settle_times():
+        """Summarise the settle times measured during the last trace over"""
+        settle_times = Transfer_Functions.TRANSFER_STATION.settle_times
+        if not settle_times:
+            return
+        times = sorted(seconds for seconds, settled in settle_times)
+        timeouts = sum(1 for seconds, settled in settle_times if not settled)
+        packet_handlers.PacketCommander.send_message(
+            f"Settle times over {len(times)} moves: mean {sum(times) / len(times):.3f}s, "
+            f"median {times[len(times) // 2]:.3f}s, max {times[-1]:.3f}s, {timeouts} hit the timeout"
+        )
+
     def generate_script(data, image_container):
         command_list = []
         
@@ -54,6 +101,8 @@ class Transfer_Functions:
             camera_index = int(data.get("camera_index", 0))
             wait_time = Transfer_Functions.MAGNIFICATION_TRAVEL[magnification].get("wait_time", 1)
             save_images = data.get("save_images", True)
+            # Wait for the image to stop moving instead of the fixed wait_time, which becomes the ceiling
+            settle_detection = bool(data.get("settle_detection", False))
 
             # Get travel distances for current magnification
             travel = Transfer_Functions.MAGNIFICATION_TRAVEL[magnification]
@@ -65,6 +114,7 @@ class Transfer_Functions:
             packet_handlers.PacketCommander.send_message(f"Steps between autofocus: {pics_until_focus}")
             packet_handlers.PacketCommander.send_message(f"Camera index: {camera_index}")
             packet_handlers.PacketCommander.send_message(f"Save images: {save_images}")
+            packet_handlers.PacketCommander.send_message(f"Settle detection: {settle_detection}")
             
             #Wafer generation
             for wafer in data.get("wafers", [{}]):
@@ -128,11 +178,15 @@ class Transfer_Functions:
                     if counter % pics_until_focus == 0:
                         command_list.append([Transfer_Functions.TRANSFER_STATION.autoFocus, camera_index])
                     # Take picture
-                    command_list.append([Transfer_Functions.TRANSFER_STATION.wait, wait_time])
+                    if settle_detection:
+                        command_list.append([Transfer_Functions.TRANSFER_STATION.wait_for_settle, wait_time, camera_index])
+                    else:
+                        command_list.append([Transfer_Functions.TRANSFER_STATION.wait, wait_time])
+                    # The frame is taken after the wait ends, never one buffered while still moving
                     if save_images:
-                        command_list.append([image_container.add_image, camera_index])
+                        command_list.append([Transfer_Functions.capture_after_wait, image_container.add_image, camera_index])
                     else:
-                        command_list.append([camera.Camera.global_list[camera_index].snap_image])
+                        command_list.append([Transfer_Functions.capture_after_wait, camera.Camera.global_list[camera_index].snap_image])
                     counter += 1
             packet_handlers.PacketCommander.send_message(f"Generated {len(points)} points and {len(command_list)} commands")
         except Exception as e:
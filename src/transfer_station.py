@@ -17,6 +17,15 @@ class Transfer_Station():
         100: {"x": 1, "y": 1, "wait_time": 1},
     }
 
+    # Settle detection: frames must move less than SETTLE_SHIFT_THRESHOLD pixels (at settle
+    # signature scale) for SETTLE_STABLE_FRAMES consecutive frames. Stability only counts once the
+    # stage is seen to have moved: a shift above the threshold between frames, or a mean difference
+    # of SETTLE_MIN_CHANGE grey levels from the frame at the start of the wait. Otherwise (the move
+    # has not started, or is not visible) the wait runs to its maximum.
+    SETTLE_SHIFT_THRESHOLD = 0.5
+    SETTLE_STABLE_FRAMES = 2
+    SETTLE_MIN_CHANGE = 8.0
+
     def __init__(self):
         print("Initializing Transfer Station")
         self.type = "base"
@@ -31,6 +40,8 @@ class Transfer_Station():
         self._last_sent_index = -1  # Track the last sent index that was retrieved
         self.camera_height = 1536
         self.camera_width = 2048
+        self.settle_times = []  # (seconds, settled) for each wait_for_settle call
+        self.settled_at = None  # time.time() at which the last wait or wait_for_settle ended
 
     # Class method to get all subclass instances
     @classmethod
@@ -104,8 +115,7 @@ class Transfer_Station():
                 self.moveZ(z)
                 self.wait(0.03)
 
-                frame = camera.Camera.global_list[camera_index].get_frame()
-                edge_count = CV_Functions.get_edge_count(frame)
+                edge_count = self._next_edge_count(camera_index)
                 edge_counts.append((z, edge_count))
             self.wait(0.1)
         
@@ -137,8 +147,7 @@ class Transfer_Station():
         while current_z >= lowest_z:
             self.moveZ(current_z)
             self.wait(0.01)
-            frame = camera.Camera.global_list[camera_index].get_frame()
-            edge_count = CV_Functions.get_edge_count(frame)
+            edge_count = self._next_edge_count(camera_index)
             fine_edge_counts.append((current_z, edge_count))
             current_z -= fine_z_step
 
@@ -151,6 +160,16 @@ class Transfer_Station():
         self.moveZ(best_z)
         self.wait(0.1)
 
+    def _next_edge_count(self, camera_index=0, timeout=1.0):
+        """Edge count of the first frame captured after this call, so it reflects the latest move"""
+        cam = camera.Camera.global_list[camera_index]
+        lease = cam.lease_frame(timeout=timeout)
+        if lease is None:
+            print(f"Timed out waiting for a new frame from camera {camera_index}")
+            return CV_Functions.get_edge_count(cam.get_frame())
+        with lease:
+            return CV_Functions.get_edge_count(lease.frame)
+
     #Takes Seconds
     def time_stamp():
         return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]     
@@ -169,6 +188,59 @@ class Transfer_Station():
     def wait(self, seconds):
         print(f"Wait for {seconds} seconds-V")
         time.sleep(seconds)
+        self.settled_at = time.time()
+
+    def wait_for_settle(self, max_wait, camera_index=0):
+        """Wait until the camera image stops moving, or max_wait seconds at most.
+        Returns the time waited in seconds."""
+        cam = camera.Camera.global_list.get(camera_index)
+        if cam is None:
+            self.wait(max_wait)
+            return max_wait
+
+        start = time.time()
+        # The newest frame when the wait starts, from before the stage got anywhere
+        reference = None
+        last_frame_id = cam.frame_id
+        if last_frame_id > 0:
+            lease = cam.lease_frame(last_frame_id - 1, timeout=max_wait)
+            if lease is not None:
+                with lease:
+                    last_frame_id = lease.frame_id
+                    reference = CV_Functions.settle_signature(lease.frame)
+        previous = reference
+        moved = False
+        stable_frames = 0
+        settled = False
+        while not settled:
+            remaining = max_wait - (time.time() - start)
+            if remaining <= 0:
+                break
+            lease = cam.lease_frame(last_frame_id, timeout=remaining)
+            if lease is None:
+                break
+            with lease:
+                last_frame_id = lease.frame_id
+                signature = CV_Functions.settle_signature(lease.frame)
+            if reference is not None and abs(signature - reference).mean() > Transfer_Station.SETTLE_MIN_CHANGE:
+                moved = True
+            if previous is not None:
+                if CV_Functions.frame_shift(previous, signature) < Transfer_Station.SETTLE_SHIFT_THRESHOLD:
+                    stable_frames += 1
+                else:
+                    stable_frames = 0
+                    moved = True
+                settled = moved and stable_frames >= Transfer_Station.SETTLE_STABLE_FRAMES
+            previous = signature
+
+        self.settled_at = time.time()
+        elapsed = self.settled_at - start
+        self.settle_times.append((elapsed, settled))
+        if settled:
+            print(f"Settled in {elapsed:.3f} seconds-V")
+        else:
+            print(f"Did not settle within {max_wait} seconds-V")
+        return elapsed
     
     def send_command_history(self, depth = -1):
         print("Send Command History-V")
@@ -0,0 +1,118 @@
+import asyncio
+import struct
+import time
+
+
+class Frame_Slot:
+    """
+    One-frame mailbox for a single viewer.
+    Publishing overwrites whatever the viewer has not picked up yet, so a slow viewer
+    skips frames instead of building up a backlog.
+    """
+
+    def __init__(self, fps=None):
+        self.fps = fps
+        self.frame_id = 0
+        self.data = None
+        self.closed = False
+        self.skipped = 0
+        self.last_sent = 0.0
+        self._event = asyncio.Event()
+
+    def put(self, frame_id, data):
+        if self._event.is_set():
+            self.skipped += 1
+        self.frame_id = frame_id
+        self.data = data
+        self._event.set()
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+
+    async def get(self):
+        """Wait for the next frame, respecting this viewer's fps cap. Returns (frame_id, data), data None once closed"""
+        if self.fps:
+            remaining = self.last_sent + 1.0 / self.fps - time.time()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+        await self._event.wait()
+        self._event.clear()
+        if self.closed:
+            return self.frame_id, None
+        self.last_sent = time.time()
+        return self.frame_id, self.data
+
+
+class Video_Broadcaster:
+    """
+    Fans the encoded frames of one camera at one (width, quality) out to every subscribed
+    Frame_Slot. One broadcaster, and so one encode per frame, exists per camera and profile
+    no matter how many viewers there are. Runs on the websocket server's event loop; the
+    blocking wait for the next frame happens in the loop's default executor.
+    """
+    # (camera_id, width, quality) -> Video_Broadcaster
+    broadcasters = dict()
+
+    # Binary video messages are this header (camera id, frame id) followed by the JPEG bytes
+    HEADER = struct.Struct("<IQ")
+
+    def __init__(self, camera_id, width, quality):
+        self.camera_id = camera_id
+        self.width = width
+        self.quality = quality
+        self.slots = set()
+        self.task = None
+
+    @classmethod
+    def subscribe(cls, camera_id, profile):
+        """Add a viewer of camera_id with a {width, quality, fps} profile. Must be called on the event loop"""
+        key = (camera_id, profile["width"], profile["quality"])
+        broadcaster = cls.broadcasters.get(key)
+        if broadcaster is None:
+            broadcaster = Video_Broadcaster(*key)
+            cls.broadcasters[key] = broadcaster
+        slot = Frame_Slot(profile.get("fps"))
+        broadcaster.slots.add(slot)
+        if broadcaster.task is None or broadcaster.task.done():
+            broadcaster.task = asyncio.create_task(broadcaster._run())
+        return slot
+
+    @classmethod
+    def unsubscribe(cls, slot):
+        """Remove a viewer; the broadcaster stops once it has none left"""
+        slot.close()
+        for key, broadcaster in list(cls.broadcasters.items()):
+            broadcaster.slots.discard(slot)
+
+    @staticmethod
+    def pack(camera_id, frame_id, jpeg):
+        return Video_Broadcaster.HEADER.pack(camera_id, frame_id) + jpeg
+
+    async def _run(self):
+        import camera  # Imported here, camera imports socket_manager which imports this module
+        loop = asyncio.get_running_loop()
+        last_frame_id = 0  # Frame ids start at 1, so this waits for the first frame
+        try:
+            while self.slots:
+                cam = camera.Camera.global_list.get(self.camera_id)
+                if cam is None or not cam.is_active:
+                    print(f"Camera {self.camera_id} not available for broadcast")
+                    break
+                frame_id, jpeg = await loop.run_in_executor(
+                    None, cam.wait_for_encoded_frame, last_frame_id, 1.0, self.width, self.quality, False
+                )
+                if jpeg is None:
+                    continue
+                last_frame_id = frame_id
+                for slot in list(self.slots):
+                    slot.put(frame_id, jpeg)
+        except Exception as e:
+            print(f"Error in video broadcast for camera {self.camera_id}: {e}")
+        finally:
+            for slot in list(self.slots):
+                slot.close()
+            self.slots.clear()
+            key = (self.camera_id, self.width, self.quality)
+            if Video_Broadcaster.broadcasters.get(key) is self:
+                del Video_Broadcaster.broadcasters[key]
@@ -0,0 +1,396 @@
+import json
+import math
+import os
+import queue
+import threading
+import cv2
+import numpy as np
+
+
+class Wafer_Mosaic:
+    """
+    Stitches the tiles of a scan into one zoomable image per wafer.
+    Each tile is placed by its stage position (optionally refined by phase correlation against
+    the previous tile where they overlap) and pasted into a pyramid of fixed-size tiles on disk,
+    mosaic/wafer_<n>/<layer>/<level>/<col>_<row>.<ext>, where level 0 is full resolution and each
+    level halves it. The "image" layer holds the captures; the "flakes" layer holds transparent
+    outlines of the flakes found by the search. The pyramid is updated as tiles arrive, on a
+    background thread, so the client can load only the visible tiles of a wafer still being scanned.
+    Tiles being pasted into are kept in memory and written losslessly (the "image" layer as PNG under
+    mosaic/wafer_<n>/work/) whenever the queue drains; each "image" tile is encoded to JPEG once,
+    when the scan moves on to the next wafer or finishes, so overlapping pastes never recompress it.
+    """
+    TILE_SIZE = 512
+    LEVELS = 7
+    JPEG_QUALITY = 85
+    LAYERS = {"image": ".jpg", "flakes": ".png"}
+    # Stage axes relative to the image: the trace over moves to lower x to go right and to
+    # higher y to go up the wafer, while image rows go down
+    X_SIGN = -1
+    Y_SIGN = -1
+    # Registration against the previous tile: correlated at this width, over at least
+    # MIN_OVERLAP pixels, accepted if the correction is under MAX_SHIFT of the frame width
+    REGISTRATION_WIDTH = 512
+    MIN_OVERLAP = 32
+    MAX_SHIFT = 0.1
+    MIN_RESPONSE = 0.1
+    # Frames waiting to be stitched; beyond this, tiles added during a scan are left for catch_up
+    MAX_QUEUE = 8
+    # Working tiles held in memory before they are written out (up to 1 MB each)
+    MAX_CACHED_TILES = 128
+    FLAKE_COLORS = [(0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0)]
+
+    def __init__(self, scan_directory: str, pixels_per_unit: float = None, field_of_view: float = None,
+                 register: bool = False):
+        """pixels_per_unit converts stage units to pixels. If it is not known, field_of_view (the
+        stage distance one frame spans horizontally) gives it from the first frame's width."""
+        self.scan_directory = scan_directory
+        self.pixels_per_unit = pixels_per_unit
+        self.field_of_view = field_of_view
+        self.register = register
+        self.wafers = dict()  # wafer index -> placement state, see _wafer
+        self.dirty = set()  # wafers whose manifest needs writing
+        self.tiles = dict()  # (wafer index, layer, level, col, row) -> working tile not yet written
+        self.unencoded = set()  # (wafer index, level, col, row) of "image" tiles whose JPEG is out of date
+        self.current_wafer = None  # wafer of the last tile placed
+        self.jobs = queue.Queue(Wafer_Mosaic.MAX_QUEUE)
+        # (wafer index, name) of tiles and flake outlines not queued because the worker was behind
+        self.deferred_lock = threading.Lock()
+        self.deferred_images = set()
+        self.deferred_flakes = set()
+        self.thread = threading.Thread(target=self._worker, name="wafer_mosaic", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def scan_path(directory: str):
+        """Full path of a scan directory name, or None if it is not a plain name"""
+        from image_container import Image_Container  # Imported here, image_container imports this module
+        if not directory or directory != os.path.basename(directory) or directory in (".", ".."):
+            return None
+        return os.path.join(Image_Container.IMAGE_REPO_NAME, directory)
+
+    @staticmethod
+    def wafer_directory(scan_directory: str, wafer_index: int):
+        return os.path.join(scan_directory, "mosaic", f"wafer_{wafer_index}")
+
+    @staticmethod
+    def tile_path(wafer_directory: str, layer: str, level: int, col: int, row: int):
+        return os.path.join(wafer_directory, layer, str(level), f"{col}_{row}{Wafer_Mosaic.LAYERS[layer]}")
+
+    @staticmethod
+    def tile_file(directory: str, wafer_index: int, layer: str, level: int, col: int, row: int):
+        """Path of a pyramid tile of the scan directory named directory, or None if there is no such tile"""
+        scan_directory = Wafer_Mosaic.scan_path(directory)
+        if scan_directory is None or layer not in Wafer_Mosaic.LAYERS:
+            return None
+        wafer_directory = Wafer_Mosaic.wafer_directory(scan_directory, wafer_index)
+        path = Wafer_Mosaic.tile_path(wafer_directory, layer, level, col, row)
+        if not os.path.exists(path) and layer == "image":
+            # Not encoded yet, the wafer is still being scanned
+            path = Wafer_Mosaic.work_path(wafer_directory, level, col, row)
+        return path if os.path.exists(path) else None
+
+    @staticmethod
+    def work_path(wafer_directory: str, level: int, col: int, row: int):
+        """Lossless working copy of an "image" layer tile, kept until the scan finishes"""
+        return os.path.join(wafer_directory, "work", "image", str(level), f"{col}_{row}.png")
+
+    @staticmethod
+    def load_manifest(scan_directory: str, wafer_index: int):
+        path = os.path.join(Wafer_Mosaic.wafer_directory(scan_directory, wafer_index), "manifest.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    # Producer side
+    def add_image(self, wafer_index: int, name: str, frame, x: float, y: float, block: bool = False):
+        """Queue a captured tile taken at stage position (x, y); frame must not be modified afterwards.
+        Unless block is set, a tile arriving while the queue is full is not waited for but left to
+        catch_up, so the scan never waits for the mosaic."""
+        self._queue(("image", wafer_index, name, frame, x, y), self.deferred_images, block)
+
+    def add_flakes(self, wafer_index: int, name: str, masks, block: bool = False):
+        """Queue the flake outlines of a tile already added; masks is a list of (full-frame mask, thickness)"""
+        self._queue(("flakes", wafer_index, name, masks), self.deferred_flakes, block)
+
+    def _queue(self, job, deferred, block):
+        if block:
+            self.jobs.put(job)
+            return
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            with self.deferred_lock:
+                deferred.add((job[1], job[2]))
+
+    def catch_up(self, image_container):
+        """Add the tiles and flake outlines left out while the worker was behind, reading them back
+        from disk, then wait until everything is in the pyramid. Called once the scan is over."""
+        with self.deferred_lock:
+            images, flakes = self.deferred_images, self.deferred_flakes
+            self.deferred_images, self.deferred_flakes = set(), set()
+        if images or flakes:
+            print(f"Adding {len(images)} tiles the wafer mosaic fell behind on")
+        for wafer_index, wafer in enumerate(image_container.metadata["wafers"]):
+            for image in wafer:
+                key = (wafer_index, image["name"])
+                if key in images:
+                    frame = image_container.load_image(image["name"], image["wafer_id"])
+                    self.add_image(wafer_index, image["name"], frame, image["x"], image["y"], block=True)
+                if key in images or key in flakes:
+                    self.add_flakes(wafer_index, image["name"], Wafer_Mosaic.flake_masks(image_container, image), block=True)
+        self.flush()
+
+    def flush(self):
+        """Wait until everything queued is in the pyramid, then encode the tiles still out of date
+        and write the manifests. Called when the scan finishes."""
+        self.jobs.put(("finish",))
+        self.jobs.join()
+
+    # Worker side
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job[0] == "finish":
+                    self._finish()
+                elif job[0] == "image":
+                    if self.current_wafer is not None and job[1] != self.current_wafer:
+                        self._finish_wafer(self.current_wafer)
+                    self.current_wafer = job[1]
+                    self._add_image(*job[1:])
+                else:
+                    self._add_flakes(*job[1:])
+            except Exception as e:
+                print(f"Error adding {job[2] if len(job) > 2 else 'the last tiles'} to the wafer mosaic: {e}")
+            finally:
+                if self.jobs.empty():
+                    try:
+                        self._write_tiles()
+                        self._write_manifests()
+                    except Exception as e:
+                        print(f"Error writing the wafer mosaic: {e}")
+                self.jobs.task_done()
+
+    def _wafer(self, wafer_index, x, y):
+        state = self.wafers.get(wafer_index)
+        if state is None:
+            state = {
+                "origin": [x, y],
+                "correction": [0.0, 0.0],  # registration offset carried on to later tiles
+                "images": dict(),  # name -> [px, py, width, height] at level 0
+                "previous": None,  # (small grayscale, px, py, width) of the last tile placed
+            }
+            self.wafers[wafer_index] = state
+        return state
+
+    def _add_image(self, wafer_index, name, frame, x, y):
+        if self.pixels_per_unit is None:
+            if not self.field_of_view:
+                raise ValueError("need pixels_per_unit or field_of_view to place tiles")
+            self.pixels_per_unit = frame.shape[1] / self.field_of_view
+        state = self._wafer(wafer_index, x, y)
+        px = Wafer_Mosaic.X_SIGN * (x - state["origin"][0]) * self.pixels_per_unit + state["correction"][0]
+        py = Wafer_Mosaic.Y_SIGN * (y - state["origin"][1]) * self.pixels_per_unit + state["correction"][1]
+
+        if self.register:
+            scale = Wafer_Mosaic.REGISTRATION_WIDTH / frame.shape[1]
+            small = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), None, fx=scale, fy=scale,
+                               interpolation=cv2.INTER_AREA).astype(np.float32)
+            shift = self._register(state["previous"], small, px, py, frame.shape[1])
+            if shift is not None:
+                px += shift[0]
+                py += shift[1]
+                state["correction"][0] += shift[0]
+                state["correction"][1] += shift[1]
+            state["previous"] = (small, px, py, frame.shape[1])
+
+        px, py = int(round(px)), int(round(py))
+        state["images"][name] = [px, py, frame.shape[1], frame.shape[0]]
+        self._paste(wafer_index, "image", frame, px, py)
+        self.dirty.add(wafer_index)
+
+    def _register(self, previous, small, px, py, width):
+        """Correction (dx, dy) in full-resolution pixels to the nominal position of a tile, found by
+        phase correlation with the previous tile where they overlap. None if it cannot be trusted."""
+        if previous is None:
+            return None
+        previous_small, previous_px, previous_py, previous_width = previous
+        if previous_width != width or previous_small.shape != small.shape:
+            return None
+        scale = small.shape[1] / width
+        dx = int(round((px - previous_px) * scale))
+        dy = int(round((py - previous_py) * scale))
+        height, width_small = small.shape
+        # Overlap in the previous tile's and this tile's coordinates
+        x0, x1 = max(0, dx), min(width_small, width_small + dx)
+        y0, y1 = max(0, dy), min(height, height + dy)
+        min_overlap = max(8, Wafer_Mosaic.MIN_OVERLAP * scale)
+        if x1 - x0 < min_overlap or y1 - y0 < min_overlap:
+            return None
+        previous_crop = previous_small[y0:y1, x0:x1]
+        crop = small[y0 - dy:y1 - dy, x0 - dx:x1 - dx]
+        window = cv2.createHanningWindow(crop.shape[::-1], cv2.CV_32F)
+        (shift_x, shift_y), response = cv2.phaseCorrelate(previous_crop, crop, window)
+        # Content shifted by +s inside this tile means the tile itself sits s further back
+        correction = (-shift_x / scale, -shift_y / scale)
+        if response < Wafer_Mosaic.MIN_RESPONSE or math.hypot(*correction) > Wafer_Mosaic.MAX_SHIFT * width:
+            return None
+        return correction
+
+    def _add_flakes(self, wafer_index, name, masks):
+        state = self.wafers.get(wafer_index)
+        if state is None or name not in state["images"] or not masks:
+            return
+        px, py, width, height = state["images"][name]
+        overlay = np.zeros((height, width, 4), dtype=np.uint8)
+        for idx, (mask, thickness) in enumerate(masks):
+            # One color per layer count where the thickness is a number
+            try:
+                color = Wafer_Mosaic.FLAKE_COLORS[int(thickness) % len(Wafer_Mosaic.FLAKE_COLORS)]
+            except (TypeError, ValueError):
+                color = Wafer_Mosaic.FLAKE_COLORS[idx % len(Wafer_Mosaic.FLAKE_COLORS)]
+            outline = cv2.morphologyEx(mask, cv2.MORPH_GRADIENT, np.ones((5, 5), np.uint8))
+            overlay[outline > 0] = (*color, 255)
+        self._paste(wafer_index, "flakes", overlay, px, py)
+
+    def _paste(self, wafer_index, layer, image, px, py):
+        """Paste image with its top left corner at (px, py) into every level of a layer.
+        Images with an alpha channel only overwrite where they are opaque."""
+        size = Wafer_Mosaic.TILE_SIZE
+        for level in range(Wafer_Mosaic.LEVELS):
+            factor = 2 ** level
+            scaled = image if level == 0 else cv2.resize(
+                image, (max(1, image.shape[1] // factor), max(1, image.shape[0] // factor)),
+                interpolation=cv2.INTER_AREA
+            )
+            x0, y0 = px // factor, py // factor
+            x1, y1 = x0 + scaled.shape[1], y0 + scaled.shape[0]
+            for row in range(y0 // size, (y1 - 1) // size + 1):
+                for col in range(x0 // size, (x1 - 1) // size + 1):
+                    key = (wafer_index, layer, level, col, row)
+                    tile = self.tiles.get(key)
+                    if tile is None:
+                        tile = self._read_tile(*key)
+                    if tile is None:
+                        tile = np.zeros((size, size, scaled.shape[2]), dtype=np.uint8)
+                    # Intersection in tile coordinates and in the scaled image's coordinates
+                    tx0, ty0 = max(x0, col * size), max(y0, row * size)
+                    tx1, ty1 = min(x1, (col + 1) * size), min(y1, (row + 1) * size)
+                    source = scaled[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0]
+                    target = tile[ty0 - row * size:ty1 - row * size, tx0 - col * size:tx1 - col * size]
+                    if scaled.shape[2] == 4:
+                        opaque = source[:, :, 3] > 0
+                        target[opaque] = source[opaque]
+                    else:
+                        target[:] = source
+                    self.tiles[key] = tile
+                    if layer == "image":
+                        self.unencoded.add((wafer_index, level, col, row))
+        if len(self.tiles) > Wafer_Mosaic.MAX_CACHED_TILES:
+            self._write_tiles()
+
+    def _working_path(self, wafer_index, layer, level, col, row):
+        wafer_directory = Wafer_Mosaic.wafer_directory(self.scan_directory, wafer_index)
+        if layer == "image":
+            return Wafer_Mosaic.work_path(wafer_directory, level, col, row)
+        return Wafer_Mosaic.tile_path(wafer_directory, layer, level, col, row)
+
+    def _read_tile(self, wafer_index, layer, level, col, row):
+        """A tile not in memory from its working copy, or from its JPEG once the working copy is gone"""
+        for path in (self._working_path(wafer_index, layer, level, col, row),
+                     Wafer_Mosaic.tile_path(Wafer_Mosaic.wafer_directory(self.scan_directory, wafer_index),
+                                            layer, level, col, row)):
+            if os.path.exists(path):
+                tile = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                if tile is not None:
+                    return tile
+        return None
+
+    def _write_tiles(self):
+        """Write the working tiles held in memory losslessly and drop them"""
+        for key, tile in self.tiles.items():
+            path = self._working_path(*key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            cv2.imwrite(path, tile)
+        self.tiles.clear()
+
+    def _finish_wafer(self, wafer_index):
+        """Encode the out of date "image" tiles of a wafer to JPEG and write its manifest"""
+        self._write_tiles()
+        wafer_directory = Wafer_Mosaic.wafer_directory(self.scan_directory, wafer_index)
+        for key in [key for key in self.unencoded if key[0] == wafer_index]:
+            tile = cv2.imread(Wafer_Mosaic.work_path(wafer_directory, *key[1:]), cv2.IMREAD_UNCHANGED)
+            if tile is not None:
+                path = Wafer_Mosaic.tile_path(wafer_directory, "image", *key[1:])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                cv2.imwrite(path, tile, [cv2.IMWRITE_JPEG_QUALITY, Wafer_Mosaic.JPEG_QUALITY])
+            self.unencoded.discard(key)
+        self._write_manifest(wafer_index)
+
+    def _finish(self):
+        """Finish every wafer and remove the working copies"""
+        import shutil
+        for wafer_index in {key[0] for key in self.unencoded} | set(self.dirty):
+            self._finish_wafer(wafer_index)
+        for wafer_index in self.wafers:
+            shutil.rmtree(os.path.join(Wafer_Mosaic.wafer_directory(self.scan_directory, wafer_index), "work"),
+                          ignore_errors=True)
+
+    def _write_manifests(self):
+        for wafer_index in list(self.dirty):
+            self._write_manifest(wafer_index)
+
+    def _write_manifest(self, wafer_index):
+        state = self.wafers.get(wafer_index)
+        if state is None or not state["images"]:
+            return
+        placed = state["images"].values()
+        manifest = {
+            "tile_size": Wafer_Mosaic.TILE_SIZE,
+            "levels": Wafer_Mosaic.LEVELS,
+            "layers": Wafer_Mosaic.LAYERS,
+            "pixels_per_unit": self.pixels_per_unit,
+            "origin": state["origin"],
+            "bounds": [min(p[0] for p in placed), min(p[1] for p in placed),
+                       max(p[0] + p[2] for p in placed), max(p[1] + p[3] for p in placed)],
+            "images": state["images"],
+        }
+        wafer_directory = Wafer_Mosaic.wafer_directory(self.scan_directory, wafer_index)
+        os.makedirs(wafer_directory, exist_ok=True)
+        temporary_path = os.path.join(wafer_directory, "manifest.json.tmp")
+        with open(temporary_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(temporary_path, os.path.join(wafer_directory, "manifest.json"))
+        self.dirty.discard(wafer_index)
+
+    @staticmethod
+    def flake_masks(image_container, image):
+        """(mask, thickness) of the recorded flakes of image confident enough for the flake layer"""
+        masks = [
+            (image_container.load_flake_mask(flake), flake.get("thickness"))
+            for flake in image.get("flakes", [])
+            if 1 - flake.get("false_positive_probability", 1) > image_container.MOSAIC_CONFIDENCE_THRESHOLD
+        ]
+        return [m for m in masks if m[0] is not None]
+
+    @staticmethod
+    def build(image_container, pixels_per_unit: float = None, field_of_view: float = None,
+              register: bool = False):
+        """Build the mosaics of a finished scan from its images and search results"""
+        import shutil
+        shutil.rmtree(os.path.join(image_container.directory, "mosaic"), ignore_errors=True)
+        mosaic = Wafer_Mosaic(image_container.directory, pixels_per_unit, field_of_view, register)
+        total = image_container.image_count()
+        done = 0
+        for wafer_index, wafer in enumerate(image_container.metadata["wafers"]):
+            for image in wafer:
+                frame = image_container.load_image(image["name"], image["wafer_id"])
+                mosaic.add_image(wafer_index, image["name"], frame, image["x"], image["y"], block=True)
+                mosaic.add_flakes(wafer_index, image["name"], Wafer_Mosaic.flake_masks(image_container, image), block=True)
+                done += 1
+                image_container.send_progress("mosaic", done, total)
+        mosaic.flush()
+        return mosaic
+
@@ -1,5 +1,10 @@
-from flask import Flask, render_template, Response, jsonify, request
+from flask import Flask, render_template, Response, jsonify, request, send_file
 from camera import Camera
+from encoder_pool import Encoder_Pool
+from flake_hunter import Flake_Hunter
+from image_writer import Image_Writer
+from wafer_mosaic import Wafer_Mosaic
+from scan_browser import Scan_Browser
 import logging
 import threading
 import atexit
@@ -24,7 +29,7 @@ def startup_flask_app():
     # Register cleanup function to run at exit
     atexit.register(cleanup_resources)
     
-    for camera in Camera.global_list.values():
+    for camera in Camera.cameras():
         camera.snap_image()
         camera.snap_image_flake_hunted()
 
@@ -54,34 +59,31 @@ def cleanup_resources():
     gc.collect()
 
 def setup_routes():
-    """Dynamically set up routes for all available cameras"""
-    # Clear any existing routes (not strictly necessary for first run)
-    for camera_id in Camera.global_list.keys():
-        # Create video feed route
-        video_endpoint = f'video_feed{camera_id}'
-        app.add_url_rule(
-            f'/video_feed{camera_id}',
-            endpoint=video_endpoint,
-            view_func=create_video_feed_route(camera_id)
-        )
+    """Set up the per-camera routes.
+    The camera id is part of the URL so cameras found after startup (background probe) are served too."""
+    app.add_url_rule(
+        '/video_feed<int:camera_id>',
+        endpoint='video_feed',
+        view_func=lambda camera_id: create_video_feed_route(camera_id)()
+    )
+    app.add_url_rule(
+        '/snapshot_feed<int:camera_id>',
+        endpoint='snapshot_feed',
+        view_func=lambda camera_id: create_snapshot_feed_route(camera_id)()
+    )
+    app.add_url_rule(
+        '/snapshot_flake_hunted<int:camera_id>',
+        endpoint='snapshot_flake_hunted',
+        view_func=lambda camera_id: create_snapshot_flake_hunted_route(camera_id)()
+    )
+    app.add_url_rule(
+        '/flake_hunt_feed<int:camera_id>',
+        endpoint='flake_hunt_feed',
+        view_func=lambda camera_id: create_flake_hunt_feed_route(camera_id)()
+    )
         
-        # Create snapshot feed route
-        snapshot_endpoint = f'snapshot_feed{camera_id}'
-        app.add_url_rule(
-            f'/snapshot_feed{camera_id}',
-            endpoint=snapshot_endpoint,
-            view_func=create_snapshot_feed_route(camera_id)
-        )
-        
-        # Create flake hunted snapshot feed route
-        snapshot_flake_hunted_endpoint = f'snapshot_flake_hunted{camera_id}'
-        app.add_url_rule(
-            f'/snapshot_flake_hunted{camera_id}',
-            endpoint=snapshot_flake_hunted_endpoint,
-            view_func=create_snapshot_flake_hunted_route(camera_id)
-        )
-        
-    print(f"Created routes for {len(Camera.global_list)} cameras: {list(Camera.global_list.keys())}")
+    camera_ids = [camera.camera_id for camera in Camera.cameras()]
+    print(f"Created routes for {len(camera_ids)} cameras: {camera_ids}")
     
 # Dynamic route creation will happen in the setup_routes function
 def create_video_feed_route(camera_id):
@@ -89,18 +91,26 @@ def create_video_feed_route(camera_id):
     def video_feed():
         # Create a unique ID for this stream
         stream_id = f"video_{camera_id}_{threading.get_ident()}"
+
+        # ?profile=preview or explicit ?width=&quality=&fps=; no parameters streams full resolution
+        profile = Camera.resolve_stream_profile(request.args)
+        client = request.remote_addr
         
-        # Close any existing streams for this camera
+        # Close any existing streams this client has open for the same camera and profile
         with stream_lock:
             for sid in list(active_streams.keys()):
-                if sid.startswith(f"video_{camera_id}_") and sid != stream_id:
-                    active_streams[sid]['active'] = False
+                stream = active_streams[sid]
+                if (sid.startswith(f"video_{camera_id}_") and sid != stream_id and isinstance(stream, dict)
+                        and stream.get('client') == client and stream.get('profile') == profile):
+                    stream['active'] = False
                     # print(f"Closing previous stream {sid} for camera {camera_id}")
         
         # Register this stream with additional information
         with stream_lock:
             active_streams[stream_id] = {
                 'camera_id': camera_id,
+                'client': client,
+                'profile': profile,
                 'start_time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
                 'active': True
             }
@@ -119,6 +129,8 @@ def create_video_feed_route(camera_id):
                 # Generate frames with a timeout to prevent blocking
                 frame_count = 0
                 start_time = time.time()
+                last_frame_id = 0  # Frame ids start at 1, so this waits for the first frame
+                last_sent = 0.0
                 
                 while True:
                     # Check if this stream is still active
@@ -127,13 +139,18 @@ def create_video_feed_route(camera_id):
                             print(f"Stream {stream_id} no longer active, stopping")
                             break
                     
-                    # Get a frame from the camera
-                    frame = camera.get_single_frame_as_response()
+                    # Block until the camera has a frame this client has not seen yet,
+                    # encoded (once, for all clients) at this stream's width and quality
+                    Camera.throttle_stream(last_sent, profile['fps'])
+                    frame_id, frame = camera.wait_for_encoded_frame(
+                        last_frame_id, timeout=1.0, width=profile['width'], quality=profile['quality']
+                    )
                     if not frame:
-                        time.sleep(0.01)  # Short sleep to prevent CPU spinning
                         continue
                     
                     # Yield the frame
+                    last_frame_id = frame_id
+                    last_sent = time.time()
                     yield frame
                     
                     # Performance monitoring
@@ -193,10 +210,97 @@ def create_snapshot_flake_hunted_route(camera_id):
             return Response(f"Flake hunted snapshot error: {str(e)}", status=500)
     return snapshot_flake_hunted_feed
 
+def create_flake_hunt_feed_route(camera_id):
+    """Create a live stream with detected flakes drawn over it for a specific camera"""
+    def flake_hunt_feed():
+        camera = Camera.global_list.get(camera_id)
+        if not camera:
+            return Response("Camera not found", status=404)
+        response = Response(Flake_Hunter.generate_video(camera),
+                            mimetype='multipart/x-mixed-replace; boundary=frame')
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        return response
+    return flake_hunt_feed
+
+@app.route('/flake_hunt_stats<int:camera_id>')
+def flake_hunt_stats(camera_id):
+    """Return viewer count, detection latency and skipped frames of a camera's flake hunt stream"""
+    camera = Camera.global_list.get(camera_id)
+    if not camera:
+        return Response("Camera not found", status=404)
+    return jsonify(Flake_Hunter.get(camera).stats())
+
+@app.route('/mosaic/<directory>/<int:wafer>/manifest.json')
+def mosaic_manifest(directory, wafer):
+    """Return the layout of a wafer mosaic: tile size, levels, bounds and where each image sits"""
+    scan_directory = Wafer_Mosaic.scan_path(directory)
+    manifest = Wafer_Mosaic.load_manifest(scan_directory, wafer) if scan_directory else None
+    if manifest is None:
+        return Response("Mosaic not found", status=404)
+    response = jsonify(manifest)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/mosaic/<directory>/<int:wafer>/<layer>/<int:level>/<int(signed=True):col>_<int(signed=True):row>.<ext>')
+def mosaic_tile(directory, wafer, layer, level, col, row, ext):
+    """Return one tile of a wafer mosaic layer; tiles nothing was pasted into are 404"""
+    path = Wafer_Mosaic.tile_file(directory, wafer, layer, level, col, row)
+    if path is None:
+        return Response("Tile not found", status=404)
+    # Tiles change while a wafer is scanned, so clients revalidate with the ETag
+    response = send_file(path, conditional=True, etag=True, max_age=0)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/scans')
+def scans():
+    """Return every scan directory with its wafer, image and searched image counts, newest first"""
+    return jsonify(Scan_Browser.scans())
+
+@app.route('/scans/<directory>')
+def scan_wafers(directory):
+    """Return the image, searched image and flake counts of each wafer of a scan"""
+    wafers = Scan_Browser.wafers(directory)
+    if wafers is None:
+        return Response("Scan not found", status=404)
+    return jsonify(wafers)
+
+@app.route('/scans/<directory>/<int:wafer>')
+def scan_images(directory, wafer):
+    """Return the images of a wafer with the versions to request their thumbnails with (?offset=&limit=)"""
+    limit = request.args.get('limit', type=int)
+    images = Scan_Browser.images(directory, wafer, request.args.get('offset', 0, type=int), limit)
+    if images is None:
+        return Response("Wafer not found", status=404)
+    return jsonify(images)
+
+@app.route('/thumbnail/<directory>/<int:wafer>/<kind>/<int:size>/<name>')
+def thumbnail(directory, wafer, kind, size, name):
+    """Return a JPEG thumbnail of a capture (kind image) or its search output (kind searched)"""
+    result = Scan_Browser.thumbnail(directory, wafer, name, kind, size)
+    if result is None:
+        return Response("Thumbnail not found", status=404)
+    path, version = result
+    response = send_file(path, mimetype='image/jpeg', conditional=True, etag=True)
+    # A request for the current version of the source can be cached for good; anything else revalidates
+    if request.args.get('v') == str(version):
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/snapshot_metrics<int:camera_id>')
+def snapshot_metrics(camera_id):
+    """Return the focus score, edge count and color ratio of a camera's current snapshot"""
+    camera = Camera.global_list.get(camera_id)
+    if not camera:
+        return Response("Camera not found", status=404)
+    return jsonify(camera.get_snapshot_metrics())
+
 @app.route('/available_cameras')
 def available_cameras():
     """Return a list of available camera IDs"""
-    return jsonify(list(Camera.global_list.keys()))
+    return jsonify([camera.camera_id for camera in Camera.cameras()])
 
 @app.route('/active_streams')
 def get_active_streams():
@@ -219,3 +323,12 @@ def get_active_streams():
         'streams': stream_info
     })
 
+@app.route('/encoder_stats')
+def encoder_stats():
+    """Return queue depth and encode latency of the shared JPEG encoder pool"""
+    return jsonify(Encoder_Pool.shared().stats())
+
+@app.route('/writer_stats')
+def writer_stats():
+    """Return queue depth, memory use and write latency of the scan image writer"""
+    return jsonify(Image_Writer.shared().stats())